@@ -0,0 +1,233 @@
+import hashlib
+import os
+import sys
+import time
+import numpy as np
+from local_index import LocalVectorIndex, exact_rerank, normalize_rows, score_rows
+
+IVF_FILE = 'ivf.npz'
+IVF_VECTORS_FILE = 'ivf_vectors.npy'
+# Rows scored per matrix product while assigning vectors to lists, and hashed per update by
+# index_fingerprint, to bound temporary memory
+ASSIGN_CHUNK = 65536
+
+def default_nlist(count):
+    """About sqrt(N) lists, so a list holds about sqrt(N) vectors"""
+    return max(1, int(round(np.sqrt(count))))
+
+def index_fingerprint(index):
+    """Hash of the keys, vectors and storage of index, so lists built for other vectors are not reused"""
+    digest = hashlib.sha256()
+    for key in index.keys:
+        digest.update(key.encode('utf-8') + b'\n')
+    vectors = index.vectors
+    compact_dtype = index.compact.dtype if index.compact is not None else None
+    digest.update(f"{vectors.shape}:{vectors.dtype}:{compact_dtype}\n".encode('utf-8'))
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        digest.update(np.ascontiguousarray(vectors[start:start + ASSIGN_CHUNK]).tobytes())
+    return digest.hexdigest()
+
+def assign_lists(vectors, centroids):
+    """Index of the most similar centroid for every row of vectors"""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        block = np.asarray(vectors[start:start + ASSIGN_CHUNK], dtype=np.float32)
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+def train_centroids(vectors, nlist, iterations=10, sample_size=None, seed=0):
+    """Spherical k-means on a sample of the (unit length) vectors"""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or 40 * nlist)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=nlist)
+        empty = counts == 0
+        # Reseed empty lists from random sample points so every list stays in use
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+class IVFIndex:
+    """Inverted-file approximate index over a LocalVectorIndex.
+
+    The vectors are clustered into nlist lists around k-means centroids. A query
+    scores the centroids, then only the vectors in its nprobe closest lists, so
+    raising nprobe trades speed for recall (nprobe = nlist is exact search).
+    A copy of the vectors is kept in list order, so each list is one contiguous
+    block scored against every query probing it in a single product. When the
+    index has float16 or int8 storage the copy is compact too, and the best
+    candidates are re-ranked with the exact vectors. Results have the same
+    shape as LocalVectorIndex.query_batch.
+    """
+
+    def __init__(self, index, centroids, vectors, order, offsets, nprobe=16, scales=None):
+        self.index = index
+        self.centroids = centroids
+        # vectors[i] is index row order[i]; list l is vectors[offsets[l]:offsets[l + 1]]
+        self.vectors = vectors
+        self.scales = scales
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, index, nlist=None, nprobe=16, iterations=10, seed=0):
+        index._apply_pending()
+        nlist = min(nlist or default_nlist(len(index.keys)), len(index.keys))
+        centroids = train_centroids(index.vectors, nlist, iterations, seed=seed)
+        assignments = assign_lists(index.vectors, centroids)
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))]).astype(np.int64)
+        if index.compact is not None:
+            vectors = np.ascontiguousarray(index.compact[order])
+            scales = np.asarray(index.scales)[order] if index.scales is not None else None
+        else:
+            vectors = np.ascontiguousarray(index.vectors[order], dtype=np.float32)
+            scales = None
+        return cls(index, centroids, vectors, order, offsets, nprobe, scales)
+
+    @classmethod
+    def load(cls, index_dir, index, nprobe=16, mmap=True):
+        """Load the lists saved next to index, or None when there are none or they are stale"""
+        path = os.path.join(index_dir, IVF_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as saved:
+            if str(saved['fingerprint']) != index_fingerprint(index):
+                print(f"Ignoring {path}: it was built for a different set of vectors")
+                return None
+            centroids, order, offsets = saved['centroids'], saved['order'], saved['offsets']
+            scales = saved['scales'] if 'scales' in saved.files else None
+        vectors = np.load(os.path.join(index_dir, IVF_VECTORS_FILE), mmap_mode='r' if mmap else None)
+        return cls(index, centroids, vectors, order, offsets, nprobe, scales)
+
+    def save(self, index_dir):
+        """Write the lists next to the index; the list file is replaced last so a partial save is ignored"""
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, IVF_VECTORS_FILE), self.vectors)
+        temp_path = os.path.join(index_dir, f"{IVF_FILE}.tmp.npz")
+        arrays = {'scales': self.scales} if self.scales is not None else {}
+        np.savez(temp_path, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                 fingerprint=np.array(index_fingerprint(self.index)), **arrays)
+        os.replace(temp_path, os.path.join(index_dir, IVF_FILE))
+
+    @staticmethod
+    def remove(index_dir):
+        """Delete lists saved by an earlier build, so they cannot be loaded for a newer index"""
+        for name in (IVF_FILE, IVF_VECTORS_FILE):
+            if os.path.exists(os.path.join(index_dir, name)):
+                os.remove(os.path.join(index_dir, name))
+
+    def __len__(self):
+        return len(self.index)
+
+    def query(self, vector, top_k=30, nprobe=None):
+        return self.query_batch(np.asarray(vector, dtype=np.float32).reshape(1, -1), top_k, nprobe)[0]
+
+    def query_batch(self, matrix, top_k=30, nprobe=None):
+        """Approximate cosine top-k for every row of an (N x dim) query matrix"""
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        queries = normalize_rows(np.asarray(matrix, dtype=np.float32).reshape(len(matrix), -1))
+        if len(queries) == 0:
+            return []
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        
+        # Score each probed list once against all the queries probing it
+        found_scores = [[] for _ in range(len(queries))]
+        found_ids = [[] for _ in range(len(queries))]
+        list_ids = probes.ravel()
+        query_ids = np.repeat(np.arange(len(queries)), nprobe)
+        by_list = np.argsort(list_ids, kind='stable')
+        lists, starts = np.unique(list_ids[by_list], return_index=True)
+        for l, members in zip(lists, np.split(query_ids[by_list], starts[1:])):
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if start == end:
+                continue
+            scales = self.scales[start:end] if self.scales is not None else None
+            scores = score_rows(self.vectors[start:end], scales, queries[members])
+            positions = np.arange(start, end)
+            for query_id, row_scores in zip(members, scores):
+                found_scores[query_id].append(row_scores)
+                found_ids[query_id].append(positions)
+        
+        # Compact scores only pick candidates; their final order comes from the exact vectors
+        compact = self.vectors.dtype != np.float32
+        keep = top_k * self.index.rerank_factor if compact else top_k
+        results = []
+        for query, scores, positions in zip(queries, found_scores, found_ids):
+            if not scores:
+                results.append([])
+                continue
+            scores = np.concatenate(scores)
+            positions = np.concatenate(positions)
+            k = min(keep, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            ids, scores = self.order[positions[top]], scores[top]
+            if compact:
+                ids, scores = next(exact_rerank(self.index.vectors, [query], [ids], top_k))
+            results.append(self.index.results(ids, scores))
+        return results
+
+    def query_vectors(self, queryVector, topK=30, returnDistance=True, returnMetadata=True, **kwargs):
+        """Same call shape and response as s3vectors.query_vectors"""
+        results = self.query(queryVector['float32'], topK)
+        for result in results:
+            if not returnDistance:
+                del result['distance']
+            if not returnMetadata:
+                del result['metadata']
+        return {'vectors': results}
+
+def recall_at_k(ann, exact, queries, k=30, nprobe=None):
+    """Mean fraction of the exact top-k keys that the approximate index also returns"""
+    approximate = ann.query_batch(queries, k, nprobe)
+    expected = exact.query_batch(queries, k)
+    hits = total = 0
+    for found, wanted in zip(approximate, expected):
+        wanted_keys = {result['key'] for result in wanted}
+        hits += len(wanted_keys & {result['key'] for result in found})
+        total += len(wanted_keys)
+    return hits / total if total else 1.0
+
+def sample_queries(index, count=200, seed=0):
+    """Stored vectors used as stand-in queries for recall checks"""
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(index.keys), min(count, len(index.keys)), replace=False))
+    return np.asarray(index.vectors[rows], dtype=np.float32)
+
+def main():
+    """Report recall@30 and query time of a saved IVF index for several nprobe values.
+
+    Usage: python ann_index.py [index_dir] [nprobe ...]
+    """
+    index_dir = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('LOCAL_INDEX_DIR', 'local_vector_index')
+    exact = LocalVectorIndex.load(index_dir)
+    ann = IVFIndex.load(index_dir, exact)
+    if ann is None:
+        print(f"No IVF index in {index_dir}; build one with generate_embeddings.py (see ANN_MIN_VECTORS)")
+        sys.exit(1)
+    queries = sample_queries(exact)
+    start = time.perf_counter()
+    exact.query_batch(queries, 30)
+    exact_seconds = time.perf_counter() - start
+    print(f"{len(exact)} vectors in {ann.nlist} lists; exact search {1000 * exact_seconds / len(queries):.2f} ms/query")
+    for nprobe in [int(value) for value in sys.argv[2:]] or [1, 4, 8, 16, 32, 64]:
+        start = time.perf_counter()
+        ann.query_batch(queries, 30, nprobe)
+        seconds = time.perf_counter() - start
+        print(f"  nprobe {nprobe}: recall@30 {recall_at_k(ann, exact, queries, 30, nprobe):.3f}, "
+              f"{1000 * seconds / len(queries):.2f} ms/query")
+
+if __name__ == "__main__":
+    main()
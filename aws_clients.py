@@ -0,0 +1,318 @@
+import asyncio
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from botocore.exceptions import ClientError
+from local_index import VECTORS_FILE, LocalVectorIndex
+
+# 'live' talks to AWS, 'fake' uses the offline stand-ins below, 'record' talks to AWS and writes
+# every response to CASSETTE_PATH, 'replay' answers only from CASSETTE_PATH
+AWS_CLIENT_MODE = os.environ.get('AWS_CLIENT_MODE', 'live')
+CASSETTE_PATH = os.environ.get('CASSETTE_PATH', os.path.join('cassettes', 'aws_calls.jsonl'))
+# Fake client behaviour: added latency per Bedrock/S3 Vectors call and per ranking call,
+# the fraction of calls that raise ThrottlingException, and the seed for that draw
+FAKE_LATENCY_MS = float(os.environ.get('FAKE_LATENCY_MS', '0'))
+FAKE_AGENT_LATENCY_MS = float(os.environ.get('FAKE_AGENT_LATENCY_MS', '0'))
+FAKE_THROTTLE_RATE = float(os.environ.get('FAKE_THROTTLE_RATE', '0'))
+FAKE_SEED = int(os.environ.get('FAKE_SEED', '0'))
+FAKE_EMBEDDING_DIMENSIONS = 1024
+# The fake S3 Vectors index starts as a copy of the local index saved here, when there is one
+FAKE_S3VECTORS_SEED_DIR = os.environ.get('FAKE_S3VECTORS_SEED_DIR', os.environ.get('LOCAL_INDEX_DIR', 'local_vector_index'))
+
+_call_counts = Counter()
+_counts_lock = threading.Lock()
+
+def count_call(name):
+    with _counts_lock:
+        _call_counts[name] += 1
+
+def call_counts():
+    """Calls made through fake, recording and replaying clients, by operation"""
+    with _counts_lock:
+        return dict(_call_counts)
+
+def _operation_name(service_name, operation, kwargs):
+    if operation == 'invoke_model':
+        return f"{service_name}.invoke_model[{kwargs.get('modelId')}]"
+    return f"{service_name}.{operation}"
+
+class _Throttler:
+    """Shared latency and throttling draw for the fake clients"""
+
+    def __init__(self, latency_ms, throttle_rate, seed):
+        self.latency = latency_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def throttled(self):
+        with self._lock:
+            return self._random.random() < self.throttle_rate
+
+    def call(self, operation_name):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttled():
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded (fake)'}},
+                              operation_name)
+
+def fake_embedding(text, dimensions=FAKE_EMBEDDING_DIMENSIONS):
+    """Deterministic unit vector from hashed character trigrams, so similar texts land close together"""
+    vector = [0.0] * dimensions
+    padded = f"  {str(text).casefold()} "
+    for i in range(len(padded) - 2):
+        digest = hashlib.md5(padded[i:i + 3].encode('utf-8')).digest()
+        index = int.from_bytes(digest[:4], 'little') % dimensions
+        vector[index] += 1.0 if digest[4] % 2 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+def fake_completion(prompt):
+    """Stand-in Claude text: the original display from re-enhancement prompts or the quoted display"""
+    original = re.search(r'^Original display: (.*)$', prompt, re.M)
+    if original:
+        return original.group(1).strip()
+    quoted = re.search(r'"([^"]+)"', prompt)
+    return quoted.group(1) if quoted else prompt.strip().splitlines()[0]
+
+class FakeBedrockRuntime:
+    """Offline bedrock-runtime: deterministic Titan embeddings and echoing Claude completions"""
+
+    def __init__(self, throttler):
+        self._throttler = throttler
+
+    def invoke_model(self, modelId, body, **kwargs):
+        count_call(_operation_name('bedrock-runtime', 'invoke_model', {'modelId': modelId}))
+        self._throttler.call('InvokeModel')
+        request = json.loads(body)
+        if 'inputText' in request:
+            response = {'embedding': fake_embedding(request['inputText'], request.get('dimensions', FAKE_EMBEDDING_DIMENSIONS))}
+        else:
+            text = fake_completion(request['messages'][-1]['content'])
+            response = {'content': [{'type': 'text', 'text': text}]}
+        return {'body': io.BytesIO(json.dumps(response).encode('utf-8'))}
+
+class FakeS3Vectors:
+    """Offline s3vectors backed by an in-memory LocalVectorIndex.
+
+    The index is seeded from the local index in seed_dir when one was saved there,
+    so a fake run with VECTOR_BACKEND=s3vectors retrieves what generate_embeddings.py
+    indexed locally; writes are kept in memory only.
+    """
+
+    def __init__(self, throttler, seed_dir=None):
+        self._throttler = throttler
+        if seed_dir and os.path.exists(os.path.join(seed_dir, VECTORS_FILE)):
+            self._index = LocalVectorIndex.load(seed_dir, mmap=False)
+        else:
+            self._index = LocalVectorIndex.empty()
+        self._lock = threading.Lock()
+
+    def _call(self, operation, **kwargs):
+        count_call(f"s3vectors.{operation}")
+        self._throttler.call(operation)
+        with self._lock:
+            return getattr(self._index, operation)(**kwargs)
+
+    def put_vectors(self, **kwargs):
+        self._call('put_vectors', **kwargs)
+        return {}
+
+    def delete_vectors(self, **kwargs):
+        self._call('delete_vectors', **kwargs)
+        return {}
+
+    def get_vectors(self, **kwargs):
+        return self._call('get_vectors', **kwargs)
+
+    def list_vectors(self, **kwargs):
+        return self._call('list_vectors', **kwargs)
+
+    def query_vectors(self, **kwargs):
+        return self._call('query_vectors', **kwargs)
+
+class Cassette:
+    """JSONL store of responses keyed by a hash of the operation and its arguments.
+
+    When the same request was recorded more than once, the last response wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    self.responses[record['key']] = record['response']
+
+    @staticmethod
+    def key(operation_name, request):
+        payload = json.dumps([operation_name, request], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def lookup(self, operation_name, request):
+        key = self.key(operation_name, request)
+        if key not in self.responses:
+            raise KeyError(f"No recorded response for {operation_name} in {self.path}; "
+                           "record one with AWS_CLIENT_MODE=record")
+        return self.responses[key]
+
+    def record(self, operation_name, request, response):
+        key = self.key(operation_name, request)
+        with self._lock:
+            self.responses[key] = response
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'key': key, 'operation': operation_name, 'response': response}, default=str) + '\n')
+
+_cassette = None
+
+def get_cassette():
+    global _cassette
+    if _cassette is None:
+        _cassette = Cassette(CASSETTE_PATH)
+    return _cassette
+
+class CassetteClient:
+    """Boto3 client proxy that records responses (client given) or replays them (client None).
+
+    Streaming 'body' fields are stored as text and handed back as file-like objects.
+    """
+
+    def __init__(self, service_name, client, cassette):
+        self._service_name = service_name
+        self._client = client
+        self._cassette = cassette
+
+    def __getattr__(self, operation):
+        def call(**kwargs):
+            operation_name = _operation_name(self._service_name, operation, kwargs)
+            count_call(operation_name)
+            if self._client is None:
+                response = dict(self._cassette.lookup(operation_name, kwargs))
+            else:
+                response = getattr(self._client, operation)(**kwargs)
+                response = {key: value for key, value in response.items() if key != 'ResponseMetadata'}
+                if 'body' in response:
+                    response['body'] = response['body'].read().decode('utf-8')
+                self._cassette.record(operation_name, kwargs, response)
+            if 'body' in response:
+                response['body'] = io.BytesIO(response['body'].encode('utf-8'))
+            return response
+        return call
+
+def responses_are_live():
+    """True when calls reach AWS, so their responses may be kept in the persistent caches"""
+    return AWS_CLIENT_MODE in ('live', 'record')
+
+def make_client(service_name, region_name):
+    """boto3 client for service_name, or its fake/recording/replaying stand-in per AWS_CLIENT_MODE"""
+    if AWS_CLIENT_MODE == 'fake':
+        throttler = _Throttler(FAKE_LATENCY_MS, FAKE_THROTTLE_RATE, FAKE_SEED)
+        if service_name == 'bedrock-runtime':
+            return FakeBedrockRuntime(throttler)
+        if service_name == 's3vectors':
+            return FakeS3Vectors(throttler, FAKE_S3VECTORS_SEED_DIR)
+        raise ValueError(f"No fake client for {service_name}")
+    if AWS_CLIENT_MODE == 'replay':
+        return CassetteClient(service_name, None, get_cassette())
+    import boto3
+    client = boto3.client(service_name, region_name=region_name)
+    if AWS_CLIENT_MODE == 'record':
+        return CassetteClient(service_name, client, get_cassette())
+    return client
+
+class _RunResult:
+    """The parts of a pydantic_ai run result the mapping code uses"""
+
+    def __init__(self, output, input_tokens, output_tokens):
+        from pydantic_ai.usage import RunUsage
+        self.output = output
+        self._usage = RunUsage(input_tokens=input_tokens, output_tokens=output_tokens)
+
+    def usage(self):
+        return self._usage
+
+class FakeAgent:
+    """Offline ranking agent that picks the first 3 options of each row, in order.
+
+    Prompts split into "ROW <id>:" blocks get one result per block when the
+    output type has a 'results' field.
+    """
+
+    def __init__(self, instructions, output_type, throttler):
+        self.instructions = instructions
+        self.output_type = output_type
+        self._throttler = throttler
+
+    @staticmethod
+    def _matches(topic):
+        codes = re.findall(r'^Code: ([^,]+), Display', topic, re.M)[:3]
+        return [{'option': code, 'reasoning': 'First listed option (fake agent).'} for code in codes]
+
+    async def run(self, prompt):
+        count_call('agent.run')
+        if self._throttler.latency:
+            await asyncio.sleep(self._throttler.latency)
+        if self._throttler.throttled():
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded (fake)'}}, 'Converse')
+        if 'results' in self.output_type.model_fields:
+            blocks = re.split(r'^ROW (\S+):\n', prompt, flags=re.M)[1:]
+            output = {'results': [{'row_id': row_id, 'matches': self._matches(block)}
+                                  for row_id, block in zip(blocks[::2], blocks[1::2])]}
+        else:
+            output = {'matches': self._matches(prompt)}
+        input_tokens = (len(self.instructions) + len(prompt)) // 4
+        output_tokens = 40 * max(1, len(output.get('results', ())))
+        return _RunResult(self.output_type.model_validate(output), input_tokens, output_tokens)
+
+class CassetteAgent:
+    """Ranking agent proxy that records run outputs (agent given) or replays them (agent None)"""
+
+    def __init__(self, agent, model_id, instructions, output_type, cassette):
+        self._agent = agent
+        self._model_id = model_id
+        self._instructions = instructions
+        self.output_type = output_type
+        self._cassette = cassette
+
+    async def run(self, prompt):
+        count_call('agent.run')
+        request = {'model': self._model_id, 'instructions': self._instructions, 'prompt': prompt}
+        if self._agent is None:
+            recorded = self._cassette.lookup('agent.run', request)
+            return _RunResult(self.output_type.model_validate(recorded['output']),
+                              recorded['input_tokens'], recorded['output_tokens'])
+        result = await self._agent.run(prompt)
+        usage = result.usage()
+        self._cassette.record('agent.run', request, {
+            'output': result.output.model_dump(),
+            'input_tokens': usage.input_tokens,
+            'output_tokens': usage.output_tokens
+        })
+        return result
+
+def make_agent(model_id, instructions, output_type):
+    """pydantic_ai Bedrock agent, or its fake/recording/replaying stand-in per AWS_CLIENT_MODE"""
+    if AWS_CLIENT_MODE == 'fake':
+        return FakeAgent(instructions, output_type, _Throttler(FAKE_AGENT_LATENCY_MS, FAKE_THROTTLE_RATE, FAKE_SEED + 1))
+    if AWS_CLIENT_MODE == 'replay':
+        return CassetteAgent(None, model_id, instructions, output_type, get_cassette())
+    from pydantic_ai import Agent
+    agent = Agent(f'bedrock:{model_id}', instructions=instructions, output_type=output_type)
+    if AWS_CLIENT_MODE == 'record':
+        return CassetteAgent(agent, model_id, instructions, output_type, get_cassette())
+    return agent
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""End-to-end throughput benchmark for create_mapping.py without AWS credentials.
+
+Builds a local index from the standard codes, then runs the proprietary sample
+through the full mapping pipeline once per scenario, each in its own process so
+scenario settings (read from the environment at import) do not leak. Clients
+default to the fakes in aws_clients.py; AWS_CLIENT_MODE=replay uses a cassette.
+
+Usage: python benchmark.py [scenario ...]
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+
+BENCHMARK_INPUT = os.environ.get('BENCHMARK_INPUT', os.path.join('testFiles', 'sample_proprietary_codes.csv'))
+BENCHMARK_STANDARD_CODES = os.environ.get('BENCHMARK_STANDARD_CODES', os.path.join('testFiles', 'common_standard_codes.csv'))
+BENCHMARK_DIR = os.environ.get('BENCHMARK_DIR', '.benchmark')
+
+# Applied unless already set, so any of them can be overridden from the environment
+DEFAULT_ENV = {
+    'AWS_CLIENT_MODE': 'fake',
+    'FAKE_LATENCY_MS': '20',
+    'FAKE_AGENT_LATENCY_MS': '200',
+    'VECTOR_BACKEND': 'local',
+    'LOCAL_INDEX_DIR': os.path.join(BENCHMARK_DIR, 'index'),
+    'EMBEDDING_CACHE_PATH': '',
+    'LLM_CACHE_PATH': '',
+    'JOURNAL_PATH': os.path.join(BENCHMARK_DIR, 'journal.jsonl'),
+    'ANN_MODE': 'off',
+}
+
+SCENARIOS = {
+    'baseline': {},
+    'throttled': {'FAKE_THROTTLE_RATE': '0.02'},
+    'batched_ranking': {'RANKING_BATCH_SIZE': '8'},
+    'hybrid_lexical': {'LEXICAL_MODE': 'hybrid'},
+    'no_dedup': {'DEDUP_MODE': 'off'},
+    'ann': {'ANN_MODE': 'auto'},
+    'speculative': {'QUERY_VARIANT_POLICY': 'speculative'},
+    'speculative_delayed': {'QUERY_VARIANT_POLICY': 'speculative', 'SPECULATIVE_REPHRASE_DELAY': '0.05'},
+    # Queries the fake S3 Vectors client, seeded from the benchmark index, one vector per call
+    's3vectors': {
+        'VECTOR_BACKEND': 's3vectors',
+        'LEXICAL_INDEX_PATH': os.path.join(BENCHMARK_DIR, 'index', 'lexical_index.json'),
+        'LOCAL_EMBEDDER_PATH': os.path.join(BENCHMARK_DIR, 'index', 'local_embedder.npz'),
+    },
+}
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+def build_index():
+    """Embed the standard codes into the local index the scenarios query"""
+    env = {**DEFAULT_ENV, **os.environ}
+    if env['AWS_CLIENT_MODE'] == 'fake':
+        # Latency and throttling only matter for the measured runs
+        env.update({'FAKE_LATENCY_MS': '0', 'FAKE_THROTTLE_RATE': '0'})
+    os.environ.update(env)
+    import generate_embeddings
+    from aws_clients import make_client
+    from lexical_index import LexicalIndex
+    from local_index import LocalVectorIndex
+
+    df = pd.read_csv(BENCHMARK_STANDARD_CODES)
+    embedder = generate_embeddings.make_embedder(df, make_client('bedrock-runtime', 'us-east-1'))
+    vector_store = LocalVectorIndex.empty()
+
+    def upload_batch(vectors_batch):
+        vector_store.put_vectors(vectors=vectors_batch)
+        return len(vectors_batch)
+
+    asyncio.run(generate_embeddings.ingest_batches(df, embedder, upload_batch))
+    vector_store.save(generate_embeddings.LOCAL_INDEX_DIR, generate_embeddings.INDEX_STORAGE)
+    if generate_embeddings.EMBEDDING_PROVIDER == 'local':
+        embedder.save(generate_embeddings.LOCAL_EMBEDDER_PATH)
+    # Built whatever the catalog size; only the ann scenario searches it
+    generate_embeddings.ANN_MIN_VECTORS = 0
+    generate_embeddings.build_ann_index(vector_store)
+    items = [generate_embeddings.build_vector_item(row, None) for _, row in df.iterrows()]
+    LexicalIndex.from_items(items).save(generate_embeddings.LEXICAL_INDEX_PATH)
+    print(f"Built benchmark index with {len(vector_store)} codes in {generate_embeddings.LOCAL_INDEX_DIR}")
+
+def run_scenario(name):
+    """Run one scenario in this process and print its result line; the environment is already set"""
+    import create_mapping
+    from aws_clients import call_counts
+
+    biomarker_df = pd.read_csv(BENCHMARK_INPUT)
+    stats = asyncio.run(create_mapping.map_rows(biomarker_df, lambda seq, mapping_row: None, collect_latencies=True))
+    latencies = np.array(stats['latencies']) if stats['latencies'] else np.zeros(1)
+    token_stats = create_mapping.token_stats
+    result = {
+        'scenario': name,
+        'rows': stats['rows'],
+        'failed_rows': stats['failed'],
+        'seconds': stats['seconds'],
+        'rows_per_second': stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0,
+        'latency_p50': float(np.percentile(latencies, 50)),
+        'latency_p95': float(np.percentile(latencies, 95)),
+        'stages': {stage.name: {'processed': stage.processed, 'errors': stage.errors,
+                                'busy_seconds': stage.busy_seconds} for stage in stats['stages']},
+        'calls': call_counts(),
+        'input_tokens': token_stats.input_tokens,
+        'output_tokens': token_stats.output_tokens,
+    }
+    print(RESULT_PREFIX + json.dumps(result))
+
+def print_report(result):
+    print(f"\n{result['scenario']}: {result['rows']} rows in {result['seconds']:.1f}s "
+          f"({result['rows_per_second']:.1f} rows/s), row latency p50 {result['latency_p50']:.2f}s, "
+          f"p95 {result['latency_p95']:.2f}s" + (f", {result['failed_rows']} rows FAILED" if result['failed_rows'] else ""))
+    print("  stages: " + ", ".join(
+        f"{name} {stage['processed']} ({stage['busy_seconds']:.1f}s busy, {stage['errors']} errors)"
+        for name, stage in result['stages'].items()
+    ))
+    for operation, count in sorted(result['calls'].items()):
+        print(f"  {operation}: {count} calls")
+    print(f"  ranking tokens: {result['input_tokens']} input, {result['output_tokens']} output")
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--run':
+        run_scenario(sys.argv[2])
+        return
+
+    names = sys.argv[1:] or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}. Choose from: {', '.join(SCENARIOS)}")
+        sys.exit(1)
+
+    base_env = {**DEFAULT_ENV, **os.environ}
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    build_index()
+
+    results = []
+    failed = []
+    for name in names:
+        print(f"Running scenario {name}...")
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run', name],
+            env={**base_env, **SCENARIOS[name]},
+            capture_output=True,
+            text=True
+        )
+        lines = [line for line in completed.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+        if completed.returncode != 0 or not lines:
+            print(f"Scenario {name} failed:\n{completed.stdout[-2000:]}{completed.stderr[-2000:]}")
+            failed.append(name)
+            continue
+        results.append(json.loads(lines[-1][len(RESULT_PREFIX):]))
+        if results[-1]['failed_rows']:
+            failed.append(name)
+
+    for result in results:
+        print_report(result)
+    results_path = os.path.join(BENCHMARK_DIR, 'results.json')
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to {results_path}")
+    if failed:
+        print(f"Error: rows failed or scenarios crashed in: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
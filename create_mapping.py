@@ -1,15 +1,27 @@
-print("Starting imports...")
-import boto3
 import json
 import pandas as pd
+import numpy as np
 import asyncio
 import time
 import os
+import functools
+import threading
 from concurrent.futures import ThreadPoolExecutor
-from pydantic_ai import Agent
 from pydantic import BaseModel
 from typing import List
-print("Imports complete")
+from local_index import LocalVectorIndex
+from ann_index import IVFIndex
+from embedding_cache import open_embedder_cache
+from embedding_providers import TITAN_MODEL_ID, open_embedder
+from llm_cache import open_llm_cache
+from rate_limiter import AdaptiveRateLimiter, call_with_backoff
+from pipeline import Stage, run_pipeline
+from mapping_journal import MappingJournal
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from prompt_builder import TokenStats, build_ranking_prompt, estimate_tokens, prune_candidates
+from aws_clients import AWS_CLIENT_MODE, make_agent, make_client
+from run_metrics import COUNT_BUCKETS, TOKEN_BUCKETS, RunMetrics
+from row_records import CandidateCatalog, read_row_chunks, rows_from_dataframe, rows_from_records
 
 class OptionResult(BaseModel):
     option: str
@@ -18,24 +30,167 @@ class OptionResult(BaseModel):
 class MatchingResult(BaseModel):
     matches: List[OptionResult]
 
+class RowMatchingResult(BaseModel):
+    row_id: str
+    matches: List[OptionResult]
+
+class BatchMatchingResult(BaseModel):
+    results: List[RowMatchingResult]
+
 # Get configuration from environment or use defaults
 VECTOR_BUCKET_NAME = 'code-mapping-vector-bucket'
 VECTOR_INDEX_NAME = 'code-mapping-vector-index'
 AWS_REGION = 'us-east-1'
+# 's3vectors' queries the S3 Vectors index, 'local' uses the index built by generate_embeddings.py
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 's3vectors')
+LOCAL_INDEX_DIR = os.environ.get('LOCAL_INDEX_DIR', 'local_vector_index')
+# 'auto' searches the local index approximately when generate_embeddings.py saved IVF lists with it,
+# probing ANN_NPROBE lists per query (more is slower with higher recall); 'off' always searches exactly
+ANN_MODE = os.environ.get('ANN_MODE', 'auto')
+ANN_NPROBE = int(os.environ.get('ANN_NPROBE', '16'))
+# Maximum number of proprietary rows scored together in one retrieval query
+RETRIEVAL_BATCH_SIZE = int(os.environ.get('RETRIEVAL_BATCH_SIZE', '256'))
+# Ceiling and starting point for concurrent ranking calls; the AIMD limiter adapts between them
+MAPPING_CONCURRENCY = int(os.environ.get('MAPPING_CONCURRENCY', '16'))
+MAPPING_INITIAL_CONCURRENCY = int(os.environ.get('MAPPING_INITIAL_CONCURRENCY', '4'))
+# Per-stage concurrency for the streaming pipeline, and the size of the queues between stages
+ENHANCE_CONCURRENCY = int(os.environ.get('ENHANCE_CONCURRENCY', '4'))
+EMBED_CONCURRENCY = int(os.environ.get('EMBED_CONCURRENCY', '8'))
+RETRIEVE_CONCURRENCY = int(os.environ.get('RETRIEVE_CONCURRENCY', '2'))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '64'))
+# How equivalent rows are grouped before any remote calls: 'exact' groups rows whose cleaned
+# display (ignoring case, whitespace and transcribed/old suffixes), type and average or
+# categories match; 'bucket' also groups averages equal to 2 significant figures and
+# categories equal as a set; 'off' sends every row through on its own
+DEDUP_MODE = os.environ.get('DEDUP_MODE', 'exact')
+# Rows packed into one ranking request (1 ranks each row on its own), the estimated token limit
+# for a packed request, and how long the rank stage waits for a batch to fill
+RANKING_BATCH_SIZE = int(os.environ.get('RANKING_BATCH_SIZE', '1'))
+RANKING_BATCH_TOKENS = int(os.environ.get('RANKING_BATCH_TOKENS', '12000'))
+RANKING_BATCH_WAIT = float(os.environ.get('RANKING_BATCH_WAIT', '0.5'))
+PROGRESS_INTERVAL = 25
+# Input rows read per chunk; only the rows in flight are held in memory
+INPUT_CHUNK_SIZE = int(os.environ.get('INPUT_CHUNK_SIZE', '10000'))
+# Run metrics report written at the end of a run: Prometheus textfile for *.prom, JSON otherwise;
+# empty disables it. A live metrics line is printed every METRICS_PROGRESS_SECONDS (0 disables)
+METRICS_PATH = os.environ.get('METRICS_PATH', 'ehr_code_mappings.metrics.json')
+METRICS_PROGRESS_SECONDS = float(os.environ.get('METRICS_PROGRESS_SECONDS', '0'))
+OUTPUT_PATH = 'ehr_code_mappings.csv'
+# Completed mappings are appended here as they finish so an interrupted run can resume
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', 'ehr_code_mappings.journal.jsonl')
+# 'shortcut' skips expansion and embedding when the display exactly matches a standard display,
+# 'hybrid' also fuses lexical and vector candidates with reciprocal-rank fusion, 'off' disables both
+LEXICAL_MODE = os.environ.get('LEXICAL_MODE', 'shortcut')
+LEXICAL_INDEX_PATH = os.environ.get(
+    'LEXICAL_INDEX_PATH',
+    os.path.join(LOCAL_INDEX_DIR, 'lexical_index.json') if VECTOR_BACKEND == 'local' else 'lexical_index.json'
+)
+TOP_K = 30
+# Ranking prompt size: candidates further than PROMPT_DISTANCE_MARGIN from the best one are dropped
+# (never below PROMPT_MIN_CANDIDATES), and instructions plus topic stay within PROMPT_TOKEN_BUDGET
+PROMPT_MAX_CANDIDATES = int(os.environ.get('PROMPT_MAX_CANDIDATES', '30'))
+PROMPT_MIN_CANDIDATES = int(os.environ.get('PROMPT_MIN_CANDIDATES', '5'))
+PROMPT_DISTANCE_MARGIN = float(os.environ.get('PROMPT_DISTANCE_MARGIN', '0.25'))
+PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', '3000'))
+RE_ENHANCE_THRESHOLD = 0.65
+# 'serial' expands acronyms, embeds and queries, then re-phrases and queries again only when the best
+# distance is over RE_ENHANCE_THRESHOLD. 'speculative' queries the raw, expanded and re-phrased display
+# variants concurrently, merges their candidates by best distance and cancels the rest once one clears
+# the threshold. The re-phrase variant starts after SPECULATIVE_REPHRASE_DELAY seconds, or as soon as the
+# other variants come back over the threshold: 0 spends a Claude call on every row for the lowest tail
+# latency, larger values issue fewer calls
+QUERY_VARIANT_POLICY = os.environ.get('QUERY_VARIANT_POLICY', 'serial')
+SPECULATIVE_REPHRASE_DELAY = float(os.environ.get('SPECULATIVE_REPHRASE_DELAY', '0'))
+EMBEDDING_MODEL_ID = TITAN_MODEL_ID
+CLAUDE_MODEL_ID = "us.anthropic.claude-sonnet-4-5-20250929-v1:0"
+# 'bedrock' (Titan) or 'local', the TF-IDF + SVD embedder generate_embeddings.py fitted on the standard codes;
+# must match the provider the index was built with
+EMBEDDING_PROVIDER = os.environ.get('EMBEDDING_PROVIDER', 'bedrock')
+LOCAL_EMBEDDER_PATH = os.environ.get(
+    'LOCAL_EMBEDDER_PATH',
+    os.path.join(LOCAL_INDEX_DIR, 'local_embedder.npz') if VECTOR_BACKEND == 'local' else 'local_embedder.npz'
+)
+# Titan v2 output size: 1024, 512 or 256; must match the dimensions the index was built with
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', '1024'))
+# A local index saved with float16 or int8 storage re-ranks this many times TOP_K candidates exactly
+INDEX_RERANK_FACTOR = int(os.environ.get('INDEX_RERANK_FACTOR', '4'))
+
+token_stats = TokenStats()
+run_metrics = RunMetrics()
+candidate_catalog = CandidateCatalog()
+_init_lock = threading.RLock()
+
+def lazy(factory):
+    """Build the value on first call and reuse it, so importing this module stays cheap"""
+    value = []
+    
+    @functools.wraps(factory)
+    def get():
+        if not value:
+            with _init_lock:
+                if not value:
+                    value.append(factory())
+        return value[0]
+    return get
+
+@lazy
+def get_bedrock():
+    client = make_client("bedrock-runtime", AWS_REGION)
+    print(f"AWS clients initialized (region: {AWS_REGION}, mode: {AWS_CLIENT_MODE})")
+    return client
+
+@lazy
+def get_vector_store():
+    if VECTOR_BACKEND == 'local':
+        store = LocalVectorIndex.load(LOCAL_INDEX_DIR, rerank_factor=INDEX_RERANK_FACTOR)
+        if len(store) and store.vectors.shape[1] != EMBEDDING_DIMENSIONS:
+            raise ValueError(f"Local index in {LOCAL_INDEX_DIR} has {store.vectors.shape[1]}-dimensional vectors "
+                             f"but EMBEDDING_DIMENSIONS is {EMBEDDING_DIMENSIONS}")
+        storage = 'float32' if store.compact is None else str(store.compact.dtype)
+        print(f"Using local vector index: {LOCAL_INDEX_DIR} ({len(store)} vectors, {storage} storage)")
+        ann = IVFIndex.load(LOCAL_INDEX_DIR, store, ANN_NPROBE) if ANN_MODE == 'auto' else None
+        if ann is not None:
+            print(f"Using approximate search: {ann.nlist} IVF lists, {ann.nprobe} probed per query")
+            return ann
+        return store
+    print(f"Using vector bucket: {VECTOR_BUCKET_NAME}")
+    print(f"Using vector index: {VECTOR_INDEX_NAME}")
+    return make_client("s3vectors", AWS_REGION)
 
-# Initialize AWS clients
-print("Initializing AWS clients...")
-bedrock = boto3.client("bedrock-runtime", region_name=AWS_REGION)
-s3vectors = boto3.client("s3vectors", region_name=AWS_REGION)
-print(f"AWS clients initialized (region: {AWS_REGION})")
-print(f"Using vector bucket: {VECTOR_BUCKET_NAME}")
-print(f"Using vector index: {VECTOR_INDEX_NAME}")
+@lazy
+def get_embedder():
+    if EMBEDDING_PROVIDER == 'local':
+        embedder = open_embedder('local', EMBEDDING_DIMENSIONS, LOCAL_EMBEDDER_PATH)
+        print(f"Using local embedder: {LOCAL_EMBEDDER_PATH} ({embedder.dimensions} dimensions)")
+        return embedder
+    return open_embedder(EMBEDDING_PROVIDER, EMBEDDING_DIMENSIONS, client=get_bedrock())
 
-# Initialize agent
-print("Initializing agent...")
-agent = Agent(
-    'bedrock:us.anthropic.claude-sonnet-4-5-20250929-v1:0',
-    instructions="""You are a medical coding expert. Match the given proprietary medical code to standard codes.
+@lazy
+def get_embedding_cache():
+    return open_embedder_cache(get_embedder())
+
+@lazy
+def get_llm_cache():
+    llm_cache = open_llm_cache()
+    if llm_cache is not None:
+        removed = llm_cache.purge_stale('ranking', AGENT_INSTRUCTIONS)
+        removed += llm_cache.purge_stale('batch_ranking', BATCH_AGENT_INSTRUCTIONS)
+        if removed:
+            print(f"Removed {removed} cached rankings from older agent instructions")
+    return llm_cache
+
+@lazy
+def get_lexical_index():
+    if LEXICAL_MODE == 'off':
+        return None
+    if not os.path.exists(LEXICAL_INDEX_PATH):
+        print(f"Lexical index {LEXICAL_INDEX_PATH} not found; run generate_embeddings.py to build it")
+        return None
+    print(f"Using lexical index: {LEXICAL_INDEX_PATH} (mode: {LEXICAL_MODE})")
+    return LexicalIndex.load(LEXICAL_INDEX_PATH)
+
+# Ranking agent instructions
+AGENT_INSTRUCTIONS = """You are a medical coding expert. Match the given proprietary medical code to standard codes.
 
 TASK: Analyze the proprietary medical test and return the 3 best matching standard codes, ranked by relevance.
 
@@ -89,39 +244,112 @@ OUTPUT: Return exactly 3 matches in ranked order using the specified Pydantic fo
 
 CRITICAL: The "option" field must contain ONLY the code with no prefixes, labels, or additional information.
 
-Do not invent codes. Only select from the provided options.""",
-    output_type=MatchingResult
-)
-print("Agent initialized")
+Do not invent codes. Only select from the provided options."""
+
+BATCH_AGENT_INSTRUCTIONS = AGENT_INSTRUCTIONS + """
+
+BATCHED INPUT: The input may contain several proprietary codes, each starting with a "ROW <id>:" line followed by its own details and STANDARD CODE OPTIONS. Match every row independently, choosing only from that row's own options. Return one result per row with "row_id" set to the row's id (the number only) and "matches" following the rules above."""
+
+@lazy
+def get_agent():
+    return make_agent(CLAUDE_MODEL_ID, AGENT_INSTRUCTIONS, MatchingResult)
+
+@lazy
+def get_batch_agent():
+    return make_agent(CLAUDE_MODEL_ID, BATCH_AGENT_INSTRUCTIONS, BatchMatchingResult)
+
+def query_vector_store(embedding, top_k=TOP_K):
+    """Query whichever vector backend is configured; both return {'vectors': [...]}"""
+    run_metrics.increment('vector_queries_total', mode='single')
+    with run_metrics.timer('vector_query_seconds', mode='single'):
+        return get_vector_store().query_vectors(
+            vectorBucketName=VECTOR_BUCKET_NAME,
+            indexName=VECTOR_INDEX_NAME,
+            queryVector={"float32": embedding},
+            topK=top_k,
+            returnDistance=True,
+            returnMetadata=True
+        )
+
+def query_local_batch(embeddings, top_k=TOP_K):
+    """Query an (N x dim) matrix of embeddings against the local index in one call"""
+    run_metrics.increment('vector_queries_total', mode='batch')
+    with run_metrics.timer('vector_query_seconds', mode='batch'):
+        return get_vector_store().query_batch(embeddings, top_k)
+
+async def query_vector_store_batch(embeddings, semaphore, top_k=TOP_K):
+    """Query an (N x dim) matrix of embeddings, returning one candidate list per row.
+
+    S3 Vectors has no batch query, so the per-vector queries run concurrently in the
+    default executor, at most as many at a time as semaphore allows.
+    """
+    if VECTOR_BACKEND == 'local':
+        return await asyncio.to_thread(query_local_batch, embeddings, top_k)
+    
+    async def query(embedding):
+        async with semaphore:
+            return (await asyncio.to_thread(query_vector_store, embedding.tolist(), top_k))["vectors"]
+    
+    return await asyncio.gather(*(query(embedding) for embedding in embeddings))
 
-def get_embedding_with_enhancement(proprietary_display, row):
-    # Remove keywords from end before checking length
+def clean_display(proprietary_display):
+    """Remove keywords from end before checking length"""
     cleaned_display = proprietary_display.rstrip()
     if cleaned_display.lower().endswith(' transcribed') or cleaned_display.lower().endswith('-transcribed'):
         cleaned_display = cleaned_display[:-12].rstrip()
     elif cleaned_display.lower().endswith(' old') or cleaned_display.lower().endswith('-old'):
         cleaned_display = cleaned_display[:-4].rstrip()
-    
-    text_to_embed = cleaned_display
-    
-    # Check if proprietary_display is short or an abbreviation and augment if needed
+    return cleaned_display
+
+def needs_acronym_expansion(cleaned_display):
+    """Check if the display is short or an abbreviation"""
     has_capitalized_word = any(len(word) >= 3 and word.isupper() for word in cleaned_display.split())
-    if len(cleaned_display) <= 5 or has_capitalized_word:
-        # Build context based on type
-        context = f"This is a {row['type']} field."
-        if row['type'] == 'numerical':
-            context += f" Average value: {row['average']}."
-        elif row['type'] == 'categorical':
-            context += f" Categories: {row['categories']}."
-        
-        claude_response = bedrock.invoke_model(
-            modelId="us.anthropic.claude-sonnet-4-5-20250929-v1:0",
+    return len(cleaned_display) <= 5 or has_capitalized_word
+
+def build_enhancement_context(row):
+    """Build context based on type"""
+    context = f"This is a {row.type} field."
+    if row.type == 'numerical':
+        context += f" Average value: {row.average}."
+    elif row.type == 'categorical':
+        context += f" Categories: {row.categories}."
+    return context
+
+def request_claude(prompt, call_type):
+    """One uncached single-turn Claude call"""
+    run_metrics.increment('claude_calls_total', call_type=call_type)
+    with run_metrics.timer('claude_call_seconds', call_type=call_type):
+        claude_response = get_bedrock().invoke_model(
+            modelId=CLAUDE_MODEL_ID,
             body=json.dumps({
                 "anthropic_version": "bedrock-2023-05-31",
                 "max_tokens": 1000,
                 "messages": [{
                     "role": "user",
-                    "content": f"""
+                    "content": prompt
+                }]
+            })
+        )
+        claude_result = json.loads(claude_response["body"].read())
+    return claude_result["content"][0]["text"]
+
+async def invoke_claude(prompt, call_type, limiter):
+    """Single-turn Claude call under limiter, answered from the LLM cache when the same prompt was seen before"""
+    llm_cache = get_llm_cache()
+    if llm_cache is not None:
+        cached = llm_cache.get(call_type, CLAUDE_MODEL_ID, None, prompt)
+        if cached is not None:
+            return cached
+    
+    text = await call_with_backoff(lambda: asyncio.to_thread(request_claude, prompt, call_type), limiter,
+                                   metrics=run_metrics, call_type=call_type)
+    if llm_cache is not None:
+        llm_cache.put(call_type, CLAUDE_MODEL_ID, None, prompt, text)
+    return text
+
+async def expand_acronym(cleaned_display, row, limiter):
+    context = build_enhancement_context(row)
+    text_to_embed = await invoke_claude(f"""
 We are mapping EHR codes to LOINC and SNOMED standards.
 
 This display is short or contains acronyms: "{cleaned_display}"
@@ -135,52 +363,25 @@ Examples:
 - "CBC" → "Complete blood count"
 - "BP" → "Blood pressure"
 - "RBC" → "Red blood cell count"
-"""
-                }]
-            })
-        )
-        claude_result = json.loads(claude_response["body"].read())
-        text_to_embed = claude_result["content"][0]["text"]
-        print(f"  Possible acronym detected. Enhanced to: {text_to_embed}")
-    
-    # Get embedding
-    response = bedrock.invoke_model(
-        modelId="amazon.titan-embed-text-v2:0",
-        body=json.dumps({"inputText": text_to_embed})
-    )
-    model_response = json.loads(response["body"].read())
-    embedding = model_response["embedding"]
-    
-    # Query vector store
-    response = s3vectors.query_vectors(
-        vectorBucketName=VECTOR_BUCKET_NAME,
-        indexName=VECTOR_INDEX_NAME,
-        queryVector={"float32": embedding},
-        topK=30,
-        returnDistance=True,
-        returnMetadata=True
-    )
-    
-    # Check if best match distance is too high and retry with improved text
-    if response["vectors"] and response["vectors"][0]["distance"] > 0.65:
-        best_distance = response["vectors"][0]["distance"]
-        # Build context based on type
-        context = f"This is a {row['type']} field."
-        if row['type'] == 'numerical':
-            context += f" Average value: {row['average']}."
-        elif row['type'] == 'categorical':
-            context += f" Categories: {row['categories']}."
-        
+""", 'acronym_expansion', limiter)
+    print(f"  Possible acronym detected. Enhanced to: {text_to_embed}")
+    return text_to_embed
+
+async def re_enhance_display(text_to_embed, row, limiter, best_distance=None):
+    """Re-phrase a display whose best match was poor; best_distance is None when re-phrasing speculatively"""
+    run_metrics.increment('re_enhancements_total')
+    if best_distance is None:
+        print(f"  Re-phrasing {text_to_embed} speculatively...")
+    else:
         print(f"  Poor embedding results (distance: {best_distance:.3f}). Re-enhancing...")
-        
-        claude_response = bedrock.invoke_model(
-            modelId="us.anthropic.claude-sonnet-4-5-20250929-v1:0",
-            body=json.dumps({
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 1000,
-                "messages": [{
-                    "role": "user",
-                    "content": f"""
+    text_to_embed = await rephrase_display(text_to_embed, row, limiter)
+    print(f"  Re-enhanced to: {text_to_embed}")
+    return text_to_embed
+
+async def rephrase_display(text_to_embed, row, limiter):
+    """The Claude re-phrasing behind re_enhance_display, without its logging or re-enhancement count"""
+    context = build_enhancement_context(row)
+    return await invoke_claude(f"""
 We are mapping this EHR display to LOINC/SNOMED codes, but got poor embedding matches.
 
 Original display: {text_to_embed}
@@ -191,192 +392,739 @@ Return a 2-5 word phrase using standard medical terminology that matches LOINC/S
 Focus on the core clinical concept. Avoid generic words like "documentation", "assessment", "pediatric".
 
 Return ONLY the improved phrase, nothing else.
-"""
-                }]
-            })
-        )
-        claude_result = json.loads(claude_response["body"].read())
-        text_to_embed = claude_result["content"][0]["text"]
-        print(f"  Re-enhanced to: {text_to_embed}")
-        
-        # Re-embed with improved text
-        response = bedrock.invoke_model(
-            modelId="amazon.titan-embed-text-v2:0",
-            body=json.dumps({"inputText": text_to_embed})
+""", 're_enhancement', limiter)
+
+def invoke_embedder(text):
+    run_metrics.increment('embedding_calls_total', provider=EMBEDDING_PROVIDER)
+    with run_metrics.timer('embedding_call_seconds', provider=EMBEDDING_PROVIDER):
+        return get_embedder().embed_one(text)
+
+async def embed_text(text, limiter):
+    """Embed text under limiter, going through the persistent embedding cache when enabled"""
+    embedding_cache = get_embedding_cache()
+    if embedding_cache is not None:
+        vector = embedding_cache.get(text)
+        if vector is not None:
+            return vector
+    vector = await call_with_backoff(lambda: asyncio.to_thread(invoke_embedder, text), limiter,
+                                     metrics=run_metrics, call_type='embedding')
+    if embedding_cache is not None:
+        embedding_cache.put(text, vector)
+    return vector
+
+def embed_texts(texts):
+    """Embed several texts in one call of a batch-native provider"""
+    embedder = get_embedder()
+    run_metrics.increment('embedding_calls_total', provider=EMBEDDING_PROVIDER)
+    with run_metrics.timer('embedding_call_seconds', provider=EMBEDDING_PROVIDER):
+        return embedder.embed(texts)
+
+def get_lexical_shortcut(cleaned_display):
+    """Candidates for a display that exactly matches a standard display, or None.
+
+    The exact matches come first, followed by the BM25 results for the display.
+    """
+    lexical_index = get_lexical_index()
+    if lexical_index is None:
+        return None
+    exact = lexical_index.exact_matches(cleaned_display)
+    if not exact:
+        return None
+    exact_keys = {result['key'] for result in exact}
+    ranked = [result for result in lexical_index.search(cleaned_display, TOP_K) if result['key'] not in exact_keys]
+    return (exact + ranked)[:TOP_K]
+
+def fuse_lexical_candidates(options, text):
+    """In hybrid mode, merge vector candidates with BM25 candidates for the same text"""
+    lexical_index = get_lexical_index()
+    if lexical_index is None or LEXICAL_MODE != 'hybrid':
+        return options
+    return reciprocal_rank_fusion([options, lexical_index.search(text, TOP_K)], TOP_K)
+
+async def get_query_text(proprietary_display, row, limiter):
+    """Cleaned display, expanded by Claude when it looks like an acronym"""
+    cleaned_display = clean_display(proprietary_display)
+    if needs_acronym_expansion(cleaned_display):
+        return await expand_acronym(cleaned_display, row, limiter)
+    return cleaned_display
+
+def merge_variant_candidates(candidate_lists, top_k=TOP_K):
+    """Union of several candidate lists, keeping each code's best distance, best first"""
+    best = {}
+    for options in candidate_lists:
+        for option in options:
+            if option['key'] not in best or option['distance'] < best[option['key']]['distance']:
+                best[option['key']] = option
+    return sorted(best.values(), key=lambda option: option['distance'])[:top_k]
+
+async def retrieve_speculatively(proprietary_display, row, limiter, embed_limiter):
+    """Query the raw, acronym-expanded and re-phrased variants of a display concurrently.
+
+    Variants still running when one clears RE_ENHANCE_THRESHOLD are cancelled.
+    Returns (text, options): the text of the variant with the best match and the
+    merged candidates of every variant that finished.
+    """
+    cleaned_display = clean_display(proprietary_display)
+    cleared = asyncio.Event()
+    texts = {}
+    
+    async def query_variant(variant, make_text):
+        text = await make_text()
+        texts[variant] = text
+        embedding = await embed_text(text, embed_limiter)
+        options = (await asyncio.to_thread(query_vector_store, embedding))["vectors"]
+        run_metrics.increment('query_variants_total', variant=variant, outcome='finished')
+        if options and options[0]["distance"] <= RE_ENHANCE_THRESHOLD:
+            cleared.set()
+        return text, options
+    
+    async def raw():
+        return cleaned_display
+    
+    async def rephrase():
+        # Re-phrase the expansion when it is already back, as the serial chain would
+        return await re_enhance_display(texts.get('expanded', cleaned_display), row, limiter)
+    
+    async def wait_for(tasks, timeout=None):
+        # Until a variant clears the threshold, every task is done or the timeout passes
+        cleared_task = asyncio.create_task(cleared.wait())
+        all_done = asyncio.ensure_future(asyncio.wait(tasks))
+        await asyncio.wait([cleared_task, all_done], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        cleared_task.cancel()
+        all_done.cancel()
+    
+    variants = {'raw': asyncio.create_task(query_variant('raw', raw))}
+    if needs_acronym_expansion(cleaned_display):
+        variants['expanded'] = asyncio.create_task(
+            query_variant('expanded', lambda: expand_acronym(cleaned_display, row, limiter))
         )
-        model_response = json.loads(response["body"].read())
-        embedding = model_response["embedding"]
+    await wait_for(list(variants.values()), SPECULATIVE_REPHRASE_DELAY)
+    if not cleared.is_set():
+        variants['rephrased'] = asyncio.create_task(query_variant('rephrased', rephrase))
+        await wait_for(list(variants.values()))
+    
+    finished = []
+    errors = []
+    for variant, task in variants.items():
+        if not task.done():
+            task.cancel()
+            run_metrics.increment('query_variants_total', variant=variant, outcome='cancelled')
+        elif task.exception() is not None:
+            errors.append(task.exception())
+        else:
+            finished.append(task.result())
+    if not finished and errors:
+        raise errors[0]
+    if not finished:
+        return cleaned_display, []
+    text = min(finished, key=lambda result: result[1][0]["distance"] if result[1] else float('inf'))[0]
+    options = merge_variant_candidates([options for _, options in finished])
+    if options:
+        print(f"  Queried {len(finished)} of {len(variants)} variants for {cleaned_display}, "
+              f"best distance: {options[0]['distance']:.3f}")
+    return text, options
+
+def build_context(row):
+    context = f"Type: {row.type}"
+    if row.type == 'numerical':
+        context += f", Average: {row.average}"
+    elif row.type == 'categorical':
+        context += f", Categories: {row.categories}"
+    return context
+
+def ranking_header(prop_display, row):
+    """Lines describing the proprietary code at the top of the ranking topic"""
+    header = f"Proprietary Code: {prop_display}\n"
+    if row.type == 'numerical':
+        header += f"Average Value: {row.average}\n"
+    if row.type == 'categorical':
+        header += f"Categories: {row.categories}\n"
+    return header
+
+def build_test_case(prop_code, prop_display, row, options, prune_by_distance=True):
+    """Build the agent topic and output metadata for one proprietary row.
+
+    Candidates are pruned and the topic is kept within PROMPT_TOKEN_BUDGET;
+    prune_by_distance should be False when distances are not cosine distances
+    (lexical or fused candidates).
+    """
+    retrieved = len(options)
+    options = prune_candidates(
+        options,
+        max_k=PROMPT_MAX_CANDIDATES,
+        min_k=PROMPT_MIN_CANDIDATES,
+        distance_margin=PROMPT_DISTANCE_MARGIN if prune_by_distance else None
+    )
+    context = build_context(row)
+    
+    # Build topic for agent
+    header = ranking_header(prop_display, row)
+    topic, options = build_ranking_prompt(
+        header, options, AGENT_INSTRUCTIONS, PROMPT_TOKEN_BUDGET, PROMPT_MIN_CANDIDATES
+    )
+    estimated_tokens = estimate_tokens(AGENT_INSTRUCTIONS) + estimate_tokens(topic)
+    token_stats.record_prompt(retrieved, len(options), estimated_tokens)
+    run_metrics.observe('prompt_estimated_tokens', estimated_tokens, buckets=TOKEN_BUCKETS)
+    run_metrics.observe('prompt_candidates', retrieved, buckets=COUNT_BUCKETS, candidates='retrieved')
+    run_metrics.observe('prompt_candidates', len(options), buckets=COUNT_BUCKETS, candidates='sent')
+    
+    return {
+        'topic': topic,
+        'prop_code': prop_code,
+        'prop_display': prop_display,
+        'context': context,
+        'options': candidate_catalog.compact(options)
+    }
+
+def build_mapping_row(metadata, result):
+    """Create one output row with all 3 options"""
+    mapping_row = {
+        'prop_code': metadata['prop_code'],
+        'prop_display': metadata['prop_display'],
+        'context': metadata['context']
+    }
+    
+    for i, match in enumerate(result.matches, 1):
+        # Find the matching option to get system, rank and display
+        rank = '-1'
+        display = 'N/A'
+        system = 'N/A'
+        for ref in metadata['options']:
+            option_metadata = candidate_catalog.metadata(ref.key)
+            if option_metadata.get('code') == match.option:
+                rank = option_metadata.get('rank', '-1')
+                display = option_metadata.get('display', 'N/A')
+                system = option_metadata.get('system', 'N/A')
+                break
         
-        # Re-query vector store
-        response = s3vectors.query_vectors(
-            vectorBucketName=VECTOR_BUCKET_NAME,
-            indexName=VECTOR_INDEX_NAME,
-            queryVector={"float32": embedding},
-            topK=30,
-            returnDistance=True,
-            returnMetadata=True
-        )
+        mapping_row[f'option_{i}_system'] = system
+        mapping_row[f'option_{i}_code'] = match.option
+        mapping_row[f'option_{i}_display'] = display
+        mapping_row[f'option_{i}_rank'] = rank
+        mapping_row[f'option_{i}_reasoning'] = match.reasoning
+    
+    return mapping_row
+
+async def run_agent(ranking_agent, prompt, call_type):
+    """One agent call, counted and timed per call_type"""
+    run_metrics.increment('agent_calls_total', call_type=call_type)
+    with run_metrics.timer('agent_call_seconds', call_type=call_type):
+        return await ranking_agent.run(prompt)
+
+async def call_agent_with_backoff(ranking_agent, prompt, limiter, max_retries=5, call_type='ranking'):
+    """Handle bedrock throttling with exponential backoff; returns the agent output"""
+    result = await call_with_backoff(lambda: run_agent(ranking_agent, prompt, call_type), limiter, max_retries,
+                                     metrics=run_metrics, call_type=call_type)
+    usage = result.usage()
+    token_stats.record_usage(usage.input_tokens, usage.output_tokens)
+    run_metrics.increment('agent_input_tokens_total', usage.input_tokens or 0, call_type=call_type)
+    run_metrics.increment('agent_output_tokens_total', usage.output_tokens or 0, call_type=call_type)
+    if usage.input_tokens is not None:
+        run_metrics.observe('agent_input_tokens', usage.input_tokens, buckets=TOKEN_BUCKETS, call_type=call_type)
+        run_metrics.observe('agent_output_tokens', usage.output_tokens or 0, buckets=TOKEN_BUCKETS,
+                            call_type=call_type)
+    return result.output
+
+async def run_with_backoff(topic, limiter, max_retries=5):
+    """Rank one topic, answered from the LLM cache when possible; returns the MatchingResult"""
+    llm_cache = get_llm_cache()
+    if llm_cache is not None:
+        cached = llm_cache.get('ranking', CLAUDE_MODEL_ID, AGENT_INSTRUCTIONS, topic)
+        if cached is not None:
+            return MatchingResult.model_validate_json(cached)
     
-    best_distance = response["vectors"][0]["distance"] if response["vectors"] else None
-    print(f"  Found {len(response['vectors'])} similar codes, best distance: {best_distance:.3f}")
-    return response["vectors"]
+    output = await call_agent_with_backoff(get_agent(), topic, limiter, max_retries)
+    if llm_cache is not None:
+        llm_cache.put('ranking', CLAUDE_MODEL_ID, AGENT_INSTRUCTIONS, topic, output.model_dump_json())
+    return output
+
+def pack_ranking_batches(test_cases):
+    """Split test cases into requests of at most RANKING_BATCH_SIZE rows and RANKING_BATCH_TOKENS tokens"""
+    batches = []
+    current = []
+    used = estimate_tokens(BATCH_AGENT_INSTRUCTIONS)
+    for test_case in test_cases:
+        cost = estimate_tokens(test_case['topic']) + 5
+        if current and (len(current) >= RANKING_BATCH_SIZE or used + cost > RANKING_BATCH_TOKENS):
+            batches.append(current)
+            current = []
+            used = estimate_tokens(BATCH_AGENT_INSTRUCTIONS)
+        current.append(test_case)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+def validate_row_result(row_result, test_case):
+    """A row's answer is usable if it has matches and every code came from its own options"""
+    if row_result is None or not row_result.matches:
+        return False
+    codes = {candidate_catalog.metadata(ref.key).get('code') for ref in test_case['options']}
+    return all(match.option in codes for match in row_result.matches)
 
-def run_with_backoff(topic, max_retries=5):
-    """Handle bedrock throttling with exponential backoff"""
-    for attempt in range(max_retries):
+async def rank_batch_with_fallback(test_cases, limiter):
+    """Rank several test cases per request, returning a MatchingResult (or None) per test case.
+
+    Rows whose answer is missing or fails validation are re-ranked one at a time.
+    """
+    llm_cache = get_llm_cache()
+    results = [None] * len(test_cases)
+    pending = []
+    for i, test_case in enumerate(test_cases):
+        cached = None
+        if llm_cache is not None:
+            cached = llm_cache.get('batch_ranking', CLAUDE_MODEL_ID, BATCH_AGENT_INSTRUCTIONS, test_case['topic'])
+        if cached is not None:
+            results[i] = MatchingResult.model_validate_json(cached)
+        else:
+            pending.append(i)
+    
+    fallback = []
+    for batch in pack_ranking_batches([test_cases[i] for i in pending]):
+        indices = [pending.pop(0) for _ in batch]
+        if len(batch) == 1:
+            fallback.extend(indices)
+            continue
+        prompt = "\n\n".join(f"ROW {row_id}:\n{test_case['topic']}" for row_id, test_case in enumerate(batch, 1))
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                result = loop.run_until_complete(agent.run(topic))
-                return result
-            finally:
-                loop.close()
+            output = await call_agent_with_backoff(get_batch_agent(), prompt, limiter, call_type='batch_ranking')
+            by_row_id = {row.row_id.strip(): row for row in output.results}
         except Exception as e:
-            if "ThrottlingException" in str(e) and attempt < max_retries - 1:
-                wait_time = (2 ** attempt) + (time.time() % 1)
-                print(f"Throttled, waiting {wait_time:.1f}s before retry {attempt + 1}")
-                time.sleep(wait_time)
+            print(f"  Batched ranking of {len(batch)} rows failed: {e}")
+            by_row_id = {}
+        for row_id, (i, test_case) in enumerate(zip(indices, batch), 1):
+            row_result = by_row_id.get(str(row_id))
+            if validate_row_result(row_result, test_case):
+                results[i] = MatchingResult(matches=row_result.matches)
+                if llm_cache is not None:
+                    llm_cache.put('batch_ranking', CLAUDE_MODEL_ID, BATCH_AGENT_INSTRUCTIONS,
+                                  test_case['topic'], results[i].model_dump_json())
             else:
-                raise e
-
-def process_batch(batch_data):
-    """Process a batch of test cases in parallel"""
-    results = []
-    batch_start = time.time()
-    success_count = 0
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        futures = [executor.submit(run_with_backoff, item['topic']) for item in batch_data]
-        for i, future in enumerate(futures):
-            try:
-                result = future.result()
-                results.append({'result': result, 'metadata': batch_data[i]})
-                success_count += 1
-            except Exception as e:
-                print(f"  Item {i+1} error: {e}")
-                results.append({'result': None, 'metadata': batch_data[i]})
-    batch_elapsed = time.time() - batch_start
-    print(f"  Successfully processed {success_count} of {len(batch_data)} items in {batch_elapsed:.1f}s")
+                fallback.append(i)
+    
+    if fallback:
+        print(f"  Ranking {len(fallback)} rows individually after batched ranking")
+    
+    async def rank_single(i):
+        try:
+            results[i] = await run_with_backoff(test_cases[i]['topic'], limiter)
+        except Exception as e:
+            print(f"  Item {test_cases[i]['seq'] + 1} error: {e}")
+    
+    await asyncio.gather(*(rank_single(i) for i in fallback))
     return results
 
-# Load biomarker data
-while True:
-    file_path = input("Enter the path to your biomarker CSV file (or 'q' to quit): ").strip()
+def build_pipeline_stages(limiter, no_candidates):
+    """Stages for the streaming mapping pipeline.
+
+    Each item is a row group from group_rows, filled in as it moves through
+    expansion, embedding, batched retrieval, re-enhancement and ranking.
+    Claude calls (expansion, re-enhancement and ranking) share limiter, as they
+    draw on the same model quota; embedding calls get their own AIMD limiter.
+    The seqs of rows dropped for having no candidates are added to no_candidates.
+    """
+    embed_limiter = AdaptiveRateLimiter(EMBED_CONCURRENCY)
+    # Bounds the S3 Vectors queries in flight across every retrieval batch
+    query_semaphore = asyncio.Semaphore(RETRIEVE_CONCURRENCY)
+    
+    async def expand(item):
+        # Exact lexical matches skip expansion, embedding and the vector query
+        cleaned_display = clean_display(item['prop_display'])
+        item['options'] = get_lexical_shortcut(cleaned_display)
+        if item['options'] is not None:
+            run_metrics.increment('lexical_shortcuts_total')
+            print(f"  Exact lexical match for {cleaned_display}, skipping embedding")
+            return item
+        if QUERY_VARIANT_POLICY == 'speculative':
+            # Every variant embeds and queries here, so the embed and retrieve stages pass the item through
+            item['text'], item['options'] = await retrieve_speculatively(item['prop_display'], item['row'], limiter, embed_limiter)
+            item['vector_search'] = True
+            item['speculative'] = True
+            run_metrics.increment('vector_searches_total')
+            return item
+        item['text'] = await get_query_text(item['prop_display'], item['row'], limiter)
+        return item
+    
+    async def embed(item):
+        # A batch-native provider embeds the whole retrieval batch at once instead
+        if item['options'] is None and not get_embedder().batch_native:
+            item['embedding'] = await embed_text(item['text'], embed_limiter)
+        return item
+    
+    async def retrieve(items):
+        pending = [item for item in items if item['options'] is None]
+        if pending:
+            if get_embedder().batch_native:
+                embeddings = np.array(await asyncio.to_thread(embed_texts, [item['text'] for item in pending]),
+                                      dtype=np.float32)
+            else:
+                embeddings = np.array([item.pop('embedding') for item in pending], dtype=np.float32)
+            results = await query_vector_store_batch(embeddings, query_semaphore)
+            for item, options in zip(pending, results):
+                item['options'] = options
+                item['vector_search'] = True
+            run_metrics.increment('vector_searches_total', len(pending))
+        return items
+    
+    async def rephrase(item, best_distance):
+        text = await re_enhance_display(item['text'], item['row'], limiter, best_distance)
+        embedding = None if get_embedder().batch_native else await embed_text(text, embed_limiter)
+        return text, embedding
+    
+    async def requery(items):
+        # Re-phrase every item of the batch whose best match is too far, then re-query them together.
+        # Returns the seqs of items whose re-phrasing failed; they are dropped like a stage error
+        searched = [item for item in items
+                    if item.get('vector_search') and not item.get('speculative') and item['options']]
+        best = np.array([item['options'][0]["distance"] for item in searched], dtype=np.float32)
+        flagged = [item for item, poor in zip(searched, best > RE_ENHANCE_THRESHOLD) if poor]
+        if not flagged:
+            return set()
+        rephrased = await asyncio.gather(
+            *(rephrase(item, item['options'][0]["distance"]) for item in flagged), return_exceptions=True
+        )
+        failed = set()
+        requeried = []
+        for item, result in zip(flagged, rephrased):
+            if isinstance(result, Exception):
+                print(f"  Item {item['seq'] + 1} error: {result}")
+                failed.add(item['seq'])
+            else:
+                item['text'], item['embedding'] = result
+                requeried.append(item)
+        if requeried:
+            if get_embedder().batch_native:
+                embeddings = await asyncio.to_thread(embed_texts, [item['text'] for item in requeried])
+            else:
+                embeddings = [item.pop('embedding') for item in requeried]
+            results = await query_vector_store_batch(np.array(embeddings, dtype=np.float32), query_semaphore)
+            for item, options in zip(requeried, results):
+                item['options'] = options
+        return failed
+    
+    async def re_enhance(items):
+        failed = await requery(items)
+        test_cases = []
+        for item in items:
+            if item['seq'] in failed:
+                continue
+            options = item.pop('options')
+            if item.get('vector_search'):
+                options = fuse_lexical_candidates(options, item['text'])
+            if not options:
+                no_candidates.update(member['seq'] for member in item['members'])
+                continue
+            cosine_distances = item.get('vector_search') and (get_lexical_index() is None or LEXICAL_MODE != 'hybrid')
+            test_case = build_test_case(item['prop_code'], item['prop_display'], item['row'], options, cosine_distances)
+            test_case['seq'] = item['seq']
+            test_case['members'] = item['members']
+            test_cases.append(test_case)
+        return test_cases
+    
+    def fan_out(test_case, result):
+        # Fan the ranking out to every row in the group, each keeping its own code, display and context
+        return {'mappings': [
+            (member['seq'], build_mapping_row({**test_case, **member}, result))
+            for member in test_case['members']
+        ]}
     
-    if file_path.lower() == 'q':
-        print("Exiting.")
-        exit(0)
+    async def rank(test_case):
+        try:
+            result = await run_with_backoff(test_case['topic'], limiter)
+        except Exception as e:
+            print(f"  Item {test_case['seq'] + 1} error: {e}")
+            return None
+        return fan_out(test_case, result)
     
-    if not os.path.exists(file_path):
-        print(f"Error: File {file_path} does not exist. Try again.")
-        continue
+    async def rank_many(test_cases):
+        results = await rank_batch_with_fallback(test_cases, limiter)
+        return [fan_out(test_case, result) for test_case, result in zip(test_cases, results) if result is not None]
     
-    if not file_path.lower().endswith('.csv'):
-        print("Error: File must be a CSV file. Try again.")
-        continue
+    if RANKING_BATCH_SIZE > 1:
+        rank_stage = Stage('rank', rank_many, MAPPING_CONCURRENCY, batch_size=RANKING_BATCH_SIZE,
+                           batch_wait=RANKING_BATCH_WAIT)
+    else:
+        rank_stage = Stage('rank', rank, MAPPING_CONCURRENCY)
     
+    # Speculative rows embed and query inside the expand stage, so it also gets the embed concurrency
+    expand_concurrency = ENHANCE_CONCURRENCY + (EMBED_CONCURRENCY if QUERY_VARIANT_POLICY == 'speculative' else 0)
+    stages = [
+        Stage('expand', expand, expand_concurrency),
+        Stage('embed', embed, EMBED_CONCURRENCY),
+        Stage('retrieve', retrieve, RETRIEVE_CONCURRENCY, batch_size=RETRIEVAL_BATCH_SIZE),
+        Stage('re_enhance', re_enhance, ENHANCE_CONCURRENCY, batch_size=RETRIEVAL_BATCH_SIZE),
+        rank_stage
+    ]
+    for stage in stages:
+        stage.handler = run_metrics.timed_async('stage_seconds', stage.handler, stage=stage.name)
+    return stages
+
+def average_key(value):
+    """An average as a number when it parses as one, so "12.5" and "12.50" group together; else its text"""
     try:
-        biomarker_df = pd.read_csv(file_path)
-        print("Input data loaded")
-        break
-    except Exception as e:
-        print(f"Error reading CSV: {e}. Try again.")
-        continue
-
-# Prepare test cases using the embedding system
-print("Preparing test cases with embedding system")
-test_cases = []
-for idx, row in biomarker_df.iterrows():
-    prop_code = str(row['proprietary_code']) if pd.notna(row['proprietary_code']) else 'N/A'
-    prop_display = str(row['proprietary_display']) if pd.notna(row['proprietary_display']) else ''
-    
-    print(f"Processing row {idx + 1}/{len(biomarker_df)}: {prop_display}")
-    
-    if prop_display:
-        options = get_embedding_with_enhancement(prop_display, row)
-        
-        if not options:
-            continue
-        
-        # Format options for the agent
-        options_text = []
-        for opt in options:
-            metadata = opt["metadata"]
-            code = metadata["code"]
-            display = metadata.get('display', 'N/A')
-            rank = metadata.get('rank', '-1')
-            options_text.append(f"Code: {code}, Display: {display}, Rank: {rank}.")
-        
-        # Build context
-        context = f"Type: {row['type']}"
-        if row['type'] == 'numerical':
-            context += f", Average: {row['average']}"
-        elif row['type'] == 'categorical':
-            context += f", Categories: {row['categories']}"
+        return repr(float(value))
+    except (TypeError, ValueError):
+        return str(value).strip()
+
+def average_bucket(value):
+    """Round an average to 2 significant figures so near-identical values group together"""
+    try:
+        return f"{float(value):.2g}"
+    except (TypeError, ValueError):
+        return str(value)
+
+def group_key(prop_display, row):
+    """Effective retrieval key: rows with the same key get the same expansion, retrieval and ranking"""
+    display = " ".join(clean_display(prop_display).split()).casefold()
+    average = categories = ''
+    if row.type == 'numerical':
+        average = average_bucket(row.average) if DEDUP_MODE == 'bucket' else average_key(row.average)
+    elif row.type == 'categorical':
+        categories = str(row.categories)
+        if DEDUP_MODE == 'bucket':
+            categories = ';'.join(sorted({c.strip().casefold() for c in categories.split(';')}))
+    return (display, str(row.type), average, categories)
+
+def group_rows(row_chunks, skip_seqs=()):
+    """Group equivalent rows so the expensive chain runs once per group.
+
+    row_chunks is an iterable of ProprietaryRow lists. Rows are grouped within
+    each chunk, so memory stays bounded however large the input is; repeats
+    in later chunks are answered by the embedding and LLM caches. The first
+    row of each group is sent through the pipeline, and every member keeps its
+    own seq, prop_code, prop_display and context for the output. Rows whose
+    seq is in skip_seqs (already mapped by a resumed run) are left out.
+    Groups are yielded chunk by chunk.
+    """
+    row_count = group_count = saved_expansions = 0
+    for rows in row_chunks:
+        groups = {}
+        for row in rows:
+            if not row.proprietary_display or row.seq in skip_seqs:
+                continue
+            row_count += 1
+            member = {'seq': row.seq, 'prop_code': row.proprietary_code, 'prop_display': row.proprietary_display,
+                      'context': build_context(row)}
+            key = row.seq if DEDUP_MODE == 'off' else group_key(row.proprietary_display, row)
+            if key in groups:
+                groups[key]['members'].append(member)
+            else:
+                groups[key] = {'seq': row.seq, 'prop_code': row.proprietary_code,
+                               'prop_display': row.proprietary_display, 'row': row, 'members': [member]}
         
-        # Build topic for agent
-        topic = f"Proprietary Code: {prop_display}\n"
-        if row['type'] == 'numerical':
-            topic += f"Average Value: {row['average']}\n"
-        if row['type'] == 'categorical':
-            topic += f"Categories: {row['categories']}\n"
+        for group in groups.values():
+            group_count += 1
+            if len(group['members']) > 1 and needs_acronym_expansion(clean_display(group['prop_display'])):
+                saved_expansions += len(group['members']) - 1
+            yield group
+    
+    if DEDUP_MODE != 'off':
+        print(f"Grouped {row_count} rows into {group_count} unique retrieval keys, saving "
+              f"{row_count - group_count} embedding, query and ranking calls "
+              f"and {saved_expansions} acronym expansions")
+
+def format_progress(completed, total):
+    return f"{completed}/{total}" if total else str(completed)
+
+def metrics_progress_line(completed, total, elapsed, limiter):
+    agent_seconds = run_metrics.histogram('agent_call_seconds', call_type='ranking')
+    searches = run_metrics.counter('vector_searches_total')
+    re_enhanced = run_metrics.counter('re_enhancements_total')
+    throttle_wait = run_metrics.histogram('throttle_wait_seconds', call_type='ranking').sum
+    return (f"  [metrics] {format_progress(completed, total)} rows, {completed / elapsed if elapsed else 0.0:.1f} rows/s, "
+            f"agent p50 {agent_seconds.quantile(0.5):.2f}s p95 {agent_seconds.quantile(0.95):.2f}s, "
+            f"{run_metrics.counter('call_retries_total', call_type='ranking')} retries, "
+            f"{throttle_wait:.1f}s throttle wait, {re_enhanced}/{searches} re-enhanced, {limiter.summary()}")
+
+def record_run_metrics(stages, limiter):
+    """Fold stage counters, limiter state, cache and prompt statistics into run_metrics as gauges"""
+    embedding_cache = get_embedding_cache()
+    llm_cache = get_llm_cache()
+    for stage in stages:
+        for field in ('processed', 'dropped', 'errors', 'busy_seconds'):
+            run_metrics.set_gauge(f'stage_{field}', getattr(stage, field), stage=stage.name)
+    run_metrics.set_gauge('limiter_final_limit', limiter.limit)
+    run_metrics.set_gauge('limiter_throttles', limiter.throttles)
+    run_metrics.set_gauge('limiter_failures', limiter.failures)
+    searches = run_metrics.counter('vector_searches_total')
+    if searches:
+        run_metrics.set_gauge('re_enhancement_rate', run_metrics.counter('re_enhancements_total') / searches)
+    if embedding_cache is not None:
+        embedding_cache.flush()
+        stats = embedding_cache.stats()
+        run_metrics.set_gauge('cache_hits', stats['hits'], cache='embedding')
+        run_metrics.set_gauge('cache_misses', stats['misses'], cache='embedding')
+        run_metrics.set_gauge('cache_hit_rate', stats['hit_rate'], cache='embedding')
+    if llm_cache is not None:
+        for call_type, stats in llm_cache.call_stats.items():
+            lookups = stats['hits'] + stats['misses']
+            run_metrics.set_gauge('cache_hits', stats['hits'], cache='llm', call_type=call_type)
+            run_metrics.set_gauge('cache_misses', stats['misses'], cache='llm', call_type=call_type)
+            run_metrics.set_gauge('cache_hit_rate', stats['hits'] / lookups if lookups else 0.0,
+                                  cache='llm', call_type=call_type)
+    if token_stats.requests:
+        run_metrics.set_gauge('prompt_candidates_sent_avg', token_stats.candidates_sent / token_stats.requests)
+        run_metrics.set_gauge('prompt_estimated_tokens_avg', token_stats.estimated_input_tokens / token_stats.requests)
+
+@lazy
+def get_executor():
+    # Blocking boto3 calls run in threads; size the pool so every stage can use its concurrency
+    workers = 2 * ENHANCE_CONCURRENCY + EMBED_CONCURRENCY + RETRIEVE_CONCURRENCY
+    if QUERY_VARIANT_POLICY == 'speculative':
+        # Up to three variants per row in the expand stage
+        workers += 3 * (ENHANCE_CONCURRENCY + EMBED_CONCURRENCY)
+    return ThreadPoolExecutor(max_workers=workers)
+
+async def map_rows(rows, on_mapping, skip_seqs=(), limiter=None, total=None, collect_latencies=False):
+    """Run every row through the streaming pipeline, calling on_mapping(seq, mapping_row) as rows finish.
+
+    rows is a DataFrame with the input columns or an iterable of ProprietaryRow
+    lists, such as row_records.read_row_chunks; total is only used for progress.
+    Rows whose seq is in skip_seqs (already mapped by a resumed run) are not sent.
+    Pass a limiter to share Claude concurrency between concurrent calls on one event loop.
+    Returns {'rows', 'failed', 'seconds', 'latencies', 'stages'}: failed counts the rows
+    lost to errors (rows without any candidates are not failures); with collect_latencies,
+    latencies are the seconds from each row entering the pipeline to its mapping being written.
+    """
+    if isinstance(rows, pd.DataFrame):
+        total = len(rows)
+        rows = [rows_from_dataframe(rows)]
+    if limiter is None:
+        limiter = AdaptiveRateLimiter(MAPPING_CONCURRENCY, MAPPING_INITIAL_CONCURRENCY)
+    # Load the embedder up front, so a missing local model fails the run instead of every row
+    get_embedder()
+    no_candidates = set()
+    stages = build_pipeline_stages(limiter, no_candidates)
+    asyncio.get_running_loop().set_default_executor(get_executor())
+    completed = 0
+    start = time.time()
+    started = {}
+    latencies = []
+    
+    def source():
+        for group in group_rows(rows, skip_seqs):
+            entered = time.perf_counter()
+            for member in group['members']:
+                started[member['seq']] = entered
+            yield group
+    
+    def sink(output):
+        nonlocal completed
+        for seq, mapping_row in output['mappings']:
+            completed += 1
+            latency = time.perf_counter() - started.pop(seq)
+            if collect_latencies:
+                latencies.append(latency)
+            run_metrics.observe('row_latency_seconds', latency)
+            run_metrics.increment('rows_mapped_total')
+            on_mapping(seq, mapping_row)
+            if completed % PROGRESS_INTERVAL == 0:
+                print(f"  Mapped {format_progress(completed, total)} rows in {time.time() - start:.1f}s ({limiter.summary()})")
+    
+    async def report_progress():
+        while True:
+            await asyncio.sleep(METRICS_PROGRESS_SECONDS)
+            print(metrics_progress_line(completed, total, time.time() - start, limiter))
+    
+    progress_task = asyncio.create_task(report_progress()) if METRICS_PROGRESS_SECONDS > 0 else None
+    try:
+        await run_pipeline(source(), stages, sink, PIPELINE_QUEUE_SIZE)
+    finally:
+        if progress_task is not None:
+            progress_task.cancel()
+        record_run_metrics(stages, limiter)
+    elapsed = time.time() - start
+    print(f"  Successfully processed {format_progress(completed, total)} rows in {elapsed:.1f}s")
+    for stage in stages:
+        print(f"  {stage.summary()}")
+    # Rows that never reached the sink either had no candidates or were lost to an error
+    failed = sorted(seq for seq in started if seq not in no_candidates)
+    if no_candidates:
+        print(f"  {len(no_candidates)} rows had no candidates and were not mapped")
+    if failed:
+        run_metrics.increment('rows_failed_total', len(failed))
+        print(f"  {len(failed)} rows failed and were not mapped (input rows "
+              f"{', '.join(str(seq + 1) for seq in failed[:10])}{', ...' if len(failed) > 10 else ''})")
+    return {'rows': completed, 'failed': len(failed), 'seconds': elapsed, 'latencies': latencies, 'stages': stages}
+
+async def map_records(records, limiter=None):
+    """Library entry point: map a list of input rows given as dicts with the CSV columns.
+
+    Returns one mapping row per record that could be mapped, in input order, and
+    raises RuntimeError when any record failed so the caller can retry the request.
+    Clients, indexes, caches and the agent are built on first use and kept.
+    """
+    mappings = {}
+    stats = await map_rows([rows_from_records(records)], mappings.__setitem__, limiter=limiter, total=len(records))
+    if stats['failed']:
+        raise RuntimeError(f"{stats['failed']} of {len(records)} rows failed to map; see the worker log")
+    return [mappings[seq] for seq in sorted(mappings)]
+
+def main():
+    # Load biomarker data
+    while True:
+        file_path = input("Enter the path to your biomarker CSV or Parquet file (or 'q' to quit): ").strip()
         
-        topic += "STANDARD CODE OPTIONS:\n" + "\n".join(options_text)
+        if file_path.lower() == 'q':
+            print("Exiting.")
+            return
         
-        test_cases.append({
-            'topic': topic,
-            'prop_code': prop_code,
-            'prop_display': prop_display,
-            'context': context,
-            'options': options
-        })
-
-# Process in batches
-print(f"Processing {len(test_cases)} mappings in batches of 3")
-all_mappings = []
-batch_size = 3
-
-for i in range(0, len(test_cases), batch_size):
-    batch = test_cases[i:i+batch_size]
-    print(f"Processing batch {i//batch_size + 1}/{(len(test_cases) + batch_size - 1)//batch_size}")
-    
-    batch_results = process_batch(batch)
-    
-    for batch_result in batch_results:
-        if batch_result['result'] is None:
+        if not os.path.exists(file_path):
+            print(f"Error: File {file_path} does not exist. Try again.")
             continue
-            
-        result = batch_result['result']
-        metadata = batch_result['metadata']
-        
-        # Create one row with all 3 options
-        mapping_row = {
-            'prop_code': metadata['prop_code'],
-            'prop_display': metadata['prop_display'],
-            'context': metadata['context']
-        }
         
-        for i, match in enumerate(result.output.matches, 1):
-            # Find the matching option to get system, rank and display
-            rank = '-1'
-            display = 'N/A'
-            system = 'N/A'
-            for opt in metadata['options']:
-                if opt["metadata"]["code"] == match.option:
-                    rank = opt["metadata"].get('rank', '-1')
-                    display = opt["metadata"].get('display', 'N/A')
-                    system = opt["metadata"].get('system', 'N/A')
-                    break
-            
-            mapping_row[f'option_{i}_system'] = system
-            mapping_row[f'option_{i}_code'] = match.option
-            mapping_row[f'option_{i}_display'] = display
-            mapping_row[f'option_{i}_rank'] = rank
-            mapping_row[f'option_{i}_reasoning'] = match.reasoning
+        if not file_path.lower().endswith(('.csv', '.parquet')):
+            print("Error: File must be a CSV or Parquet file. Try again.")
+            continue
         
-        all_mappings.append(mapping_row)
+        # Read only the first chunk here; the rows are streamed in chunks while mapping
+        try:
+            next(read_row_chunks(file_path, 1), None)
+            print("Input data found")
+            break
+        except Exception as e:
+            print(f"Error reading input: {e}. Try again.")
+            continue
+    
+    # Resume from the journal of an interrupted run of the same file
+    journal = MappingJournal(JOURNAL_PATH)
+    journal_input, journal_entries = journal.read()
+    resume = False
+    if journal_entries and journal_input == os.path.abspath(file_path):
+        answer = input(f"Found {len(journal_entries)} completed mappings from a previous run of this file. Resume? (y/n): ")
+        resume = answer.strip().lower() == 'y'
+    skip_seqs = {seq for seq, _ in journal_entries} if resume else set()
+    journal.start(file_path, resume)
+    if resume:
+        print(f"Resuming: skipping {len(skip_seqs)} already mapped rows")
+    
+    # Stream rows through expansion, embedding, retrieval and ranking, journaling each mapping as it completes
+    print(f"Mapping rows in chunks of {INPUT_CHUNK_SIZE} with up to {MAPPING_CONCURRENCY} concurrent ranking requests")
+    try:
+        stats = asyncio.run(map_rows(read_row_chunks(file_path, INPUT_CHUNK_SIZE), journal.append, skip_seqs))
+    except KeyboardInterrupt:
+        journal.close()
+        print(f"Interrupted. Completed mappings are saved in '{JOURNAL_PATH}'; run again on the same file to resume.")
+        exit(1)
+    journal.close()
+    
+    # Compact the journal into the mappings CSV
+    mapping_count = journal.compact(OUTPUT_PATH)
+    print(f"Mapping complete. Created {mapping_count} mappings saved to '{OUTPUT_PATH}'")
+    embedding_cache = get_embedding_cache()
+    llm_cache = get_llm_cache()
+    if embedding_cache is not None:
+        print(embedding_cache.summary())
+    if llm_cache is not None:
+        print(llm_cache.summary())
+    print(token_stats.summary())
+    if METRICS_PATH:
+        run_metrics.write(METRICS_PATH)
+        print(f"Run metrics saved to '{METRICS_PATH}'")
+    if stats['failed']:
+        print(f"Error: {stats['failed']} rows failed to map and are missing from '{OUTPUT_PATH}'. "
+              "Run again on the same file and resume to retry them.")
+        exit(1)
 
-# Save mappings to CSV
-mappings_df = pd.DataFrame(all_mappings)
-mappings_df.to_csv('ehr_code_mappings.csv', index=False)
-print(f"Mapping complete. Created {len(all_mappings)} mappings saved to 'ehr_code_mappings.csv'")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,28 @@
 import pandas as pd
+import numpy as np
 import json
+import os
+import tempfile
+from array import array
 from datetime import datetime
+from itertools import groupby
 
-def csv_to_fhir_conceptmap(csv_path, output_path=None):
-    
-    # Read CSV
-    df = pd.read_csv(csv_path)
-    
-    # Initialize ConceptMap structure with overall identifiers
-    concept_map = {
+TARGET_SYSTEMS = [("LOINC", "http://loinc.org"), ("SNOMED CT", "http://snomed.info/sct")]
+# Columns read as text so codes keep their exact spelling whichever chunk they land in
+TEXT_COLUMNS = ['prop_code', 'prop_display', 'context', 'validated_system', 'validated_code', 'validated_display',
+                'validated_reasoning'] + [f'option_{i}_{field}' for i in range(1, 4)
+                                          for field in ('system', 'code', 'display', 'reasoning')]
+CHUNK_SIZE = 50000
+
+def concept_map_header(date=None):
+    """ConceptMap fields that precede the groups"""
+    return {
         "resourceType": "ConceptMap",
         "version": "1.0.0",
         "name": "EHRCodeMappings",
         "title": "EHR Code Mappings to Standard Terminologies",
         "status": "active",
-        "date": datetime.now().isoformat(),
+        "date": date or datetime.now().isoformat(),
         "publisher": "EHR Code Mapper",
         "description": "AI-generated mappings from proprietary EHR codes to LOINC and SNOMED CT",
         "property": [
@@ -36,6 +44,14 @@ def csv_to_fhir_conceptmap(csv_path, output_path=None):
         ],
         "group": []
     }
+
+def csv_to_fhir_conceptmap(csv_path, output_path=None, date=None):
+    
+    # Read CSV
+    df = pd.read_csv(csv_path)
+    
+    # Initialize ConceptMap structure with overall identifiers
+    concept_map = concept_map_header(date)
     
     # Separate groups by target system in compliance with FHIR standards
     loinc_group = {
@@ -161,7 +177,170 @@ def csv_to_fhir_conceptmap(csv_path, output_path=None):
     print(f"FHIR ConceptMap saved to: {output_path}")
     return concept_map
 
+def read_mapping_chunks(path, chunksize=CHUNK_SIZE):
+    """Yield a mapping CSV or Parquet file as DataFrames of at most chunksize rows"""
+    if path.lower().endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet mapping files requires pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+        return
+    columns = pd.read_csv(path, nrows=0).columns
+    dtype = {column: str for column in TEXT_COLUMNS if column in columns}
+    yield from pd.read_csv(path, chunksize=chunksize, dtype=dtype)
+
+def melt_targets(chunk, keys, first_row):
+    """One row per mapping row and option that has a system and code, in row then preference order"""
+    if 'validated_system' in chunk.columns:
+        options = [('validated', 1)]
+    else:
+        options = [(f'option_{i}', i) for i in range(1, 4)]
+    rows = np.arange(first_row, first_row + len(chunk))
+    parts = []
+    for prefix, preference in options:
+        part = pd.DataFrame({
+            'row': rows,
+            'preference': preference,
+            'prop_code': keys,
+            'system': chunk[f'{prefix}_system'].to_numpy(),
+            'code': chunk[f'{prefix}_code'].to_numpy(),
+            'display': chunk[f'{prefix}_display'].to_numpy(),
+            'rank': pd.to_numeric(chunk[f'{prefix}_rank'], errors='coerce').to_numpy(),
+            'reasoning': chunk[f'{prefix}_reasoning'].to_numpy()
+        })
+        parts.append(part[part['system'].notna() & part['code'].notna()])
+    targets = pd.concat(parts, ignore_index=True)
+    return targets.sort_values(['row', 'preference'], kind='stable')
+
+def _spooled_targets(spool, orders, lengths):
+    """Read spooled (order, target text) pairs back in code order, keeping row order within a code"""
+    if len(orders) and np.any(np.diff(orders) < 0):
+        offsets = np.cumsum(lengths) - lengths
+        for index in np.argsort(orders, kind='stable'):
+            spool.seek(offsets[index])
+            yield orders[index], spool.read(lengths[index]).decode('utf-8')
+        return
+    spool.seek(0)
+    for order, length in zip(orders, lengths):
+        yield order, spool.read(length).decode('utf-8')
+
+def _indent(text, spaces):
+    return text.replace('\n', '\n' + ' ' * spaces)
+
+# Targets and elements are rendered the way json.dump(concept_map, indent=2) lays them out:
+# elements sit 8 spaces deep and their targets 12
+def _render_target(code, display, reasoning, preference, rank):
+    properties = [f'{" " * 16}{{\n{" " * 18}"code": "preferenceRank",\n{" " * 18}"valueInteger": {preference}\n{" " * 16}}}']
+    if rank is not None:
+        properties.append(f'{" " * 16}{{\n{" " * 18}"code": "frequencyRank",\n{" " * 18}"valueInteger": {rank}\n{" " * 16}}}')
+    pad = " " * 14
+    return (f'{" " * 12}{{\n'
+            f'{pad}"code": {json.dumps(code)},\n'
+            f'{pad}"display": {json.dumps(display)},\n'
+            f'{pad}"relationship": "equivalent",\n'
+            f'{pad}"comment": {json.dumps(reasoning)},\n'
+            f'{pad}"property": [\n' + ',\n'.join(properties) + f'\n{pad}]\n'
+            f'{" " * 12}}}')
+
+def _render_element(code, display, data_type, targets):
+    pad = " " * 10
+    return (f'{" " * 8}{{\n'
+            f'{pad}"code": {json.dumps(code)},\n'
+            f'{pad}"display": {json.dumps(display)},\n'
+            f'{pad}"property": [\n'
+            f'{" " * 12}{{\n{" " * 14}"code": "proprietaryCodeDataType",\n{" " * 14}"valueString": {json.dumps(data_type)}\n{" " * 12}}}\n'
+            f'{pad}],\n'
+            f'{pad}"target": [\n' + ',\n'.join(targets) + f'\n{pad}]\n'
+            f'{" " * 8}}}')
+
+def write_fhir_conceptmap(input_path, output_path=None, chunksize=CHUNK_SIZE, date=None):
+    """Streaming csv_to_fhir_conceptmap for large CSV or Parquet mapping files.
+
+    Rows are read in chunks and the option or validated columns are melted into
+    target rows with pandas. Targets are rendered as JSON text and spooled per
+    system to temporary files, then the ConceptMap is written group by group and
+    element by element.
+    Memory holds the distinct proprietary codes plus 16 bytes per target.
+    Apart from reading code and display columns as text, the output is
+    byte-identical to csv_to_fhir_conceptmap for the same date. Returns
+    {'output_path', 'codes', 'targets'}.
+    """
+    code_index = {}
+    code_displays = []
+    code_types = []
+    spools = {system: tempfile.TemporaryFile() for system, _ in TARGET_SYSTEMS}
+    # Per spooled target: its code's first-seen order and its length in bytes in the spool
+    orders = {system: array('q') for system, _ in TARGET_SYSTEMS}
+    target_lengths = {system: array('q') for system, _ in TARGET_SYSTEMS}
+    first_row = 0
+    try:
+        for chunk in read_mapping_chunks(input_path, chunksize):
+            keys = chunk['prop_code'].astype(str).to_numpy()
+            # The first row of each proprietary code supplies its display and data type
+            firsts = pd.DataFrame({'key': keys, 'display': chunk['prop_display'].to_numpy(),
+                                   'context': chunk['context'].to_numpy()}).drop_duplicates('key')
+            for key, display, context in zip(firsts['key'], firsts['display'].tolist(), firsts['context'].tolist()):
+                if key not in code_index:
+                    code_index[key] = len(code_displays)
+                    code_displays.append(display)
+                    code_types.append("numerical" if "numerical" in context else "categorical")
+            
+            targets = melt_targets(chunk, keys, first_row)
+            first_row += len(chunk)
+            targets['order'] = targets['prop_code'].map(code_index)
+            has_rank = targets['rank'].notna() & (targets['rank'] != -1)
+            for system, _ in TARGET_SYSTEMS:
+                selected = targets[targets['system'] == system]
+                spool = spools[system]
+                for code, display, reasoning, preference, rank, rank_ok in zip(
+                        selected['code'].astype(str).tolist(), selected['display'].tolist(),
+                        selected['reasoning'].tolist(), selected['preference'].tolist(),
+                        selected['rank'].tolist(), has_rank[selected.index].tolist()):
+                    text = _render_target(code, display, reasoning, preference, int(rank) if rank_ok else None)
+                    encoded = text.encode('utf-8')
+                    spool.write(encoded)
+                    target_lengths[system].append(len(encoded))
+                orders[system].extend(selected['order'].tolist())
+        
+        if output_path is None:
+            if input_path.lower().endswith('.csv'):
+                output_path = input_path.replace('.csv', '_fhir.json')
+            else:
+                output_path = os.path.splitext(input_path)[0] + '_fhir.json'
+        
+        target_counts = {system: len(orders[system]) for system, _ in TARGET_SYSTEMS}
+        code_keys = list(code_index)
+        with open(output_path, 'w') as f:
+            # Everything up to the group list comes from the same header json.dump would write
+            header = json.dumps(concept_map_header(date), indent=2)
+            f.write(header[:-len('[]\n}')])
+            written_groups = 0
+            for system, url in TARGET_SYSTEMS:
+                if not target_counts[system]:
+                    continue
+                f.write(',\n' if written_groups else '[\n')
+                written_groups += 1
+                group = json.dumps({"source": "Proprietary Code System", "target": url, "element": []}, indent=2)
+                f.write('    ' + _indent(group[:-len('[]\n}')], 4) + '[\n')
+                
+                spooled = _spooled_targets(spools[system], np.frombuffer(orders[system], dtype=np.int64),
+                                           np.frombuffer(target_lengths[system], dtype=np.int64))
+                for i, (order, pairs) in enumerate(groupby(spooled, key=lambda pair: pair[0])):
+                    element = _render_element(code_keys[order], code_displays[order], code_types[order],
+                                              [target for _, target in pairs])
+                    f.write((',\n' if i else '') + element)
+                f.write('\n      ]\n    }')
+            f.write('\n  ]\n}' if written_groups else '[]\n}')
+    finally:
+        for spool in spools.values():
+            spool.close()
+    
+    print(f"FHIR ConceptMap saved to: {output_path}")
+    return {'output_path': output_path, 'codes': len(code_index), 'targets': target_counts}
+
 # Create the FHIR output from the CSV file created in the mapping process
 if __name__ == "__main__":
-    csv_path = input("Enter the CSV file path: ").strip()
-    csv_to_fhir_conceptmap(csv_path)
\ No newline at end of file
+    csv_path = input("Enter the CSV or Parquet file path: ").strip()
+    write_fhir_conceptmap(csv_path)
\ No newline at end of file
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+from aws_clients import responses_are_live
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by (model id, dimension, normalized text hash).
+
+    Vectors are stored as float32 blobs in SQLite. Once the cache holds more than
+    max_entries vectors the least recently used ones are evicted. Hits only update
+    last_used in memory; the updates are written every flush_every hits, on put
+    and on close, so a hit costs no write transaction.
+    """
+
+    def __init__(self, path, model_id, dimensions, max_entries=500000, flush_every=256):
+        self.model_id = model_id
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._touched = {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._size, self._clock = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(MAX(last_used), 0) FROM embeddings"
+        ).fetchone()
+
+    def key(self, text):
+        normalized = " ".join(text.split())
+        digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        return f"{self.model_id}:{self.dimensions}:{digest}"
+
+    def get(self, text):
+        key = self.key(text)
+        with self._lock:
+            row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            self._touched[key] = self._clock
+            if len(self._touched) >= self.flush_every:
+                self._flush_touched()
+                self._conn.commit()
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def put(self, text, vector):
+        key = self.key(text)
+        blob = np.asarray(vector, dtype=np.float32).tobytes()
+        with self._lock:
+            # Written first so eviction sees every hit and a re-put key keeps its newer clock
+            self._flush_touched()
+            self._clock += 1
+            exists = self._conn.execute("SELECT 1 FROM embeddings WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                (key, blob, self._clock)
+            )
+            if not exists:
+                self._size += 1
+            if self._size > self.max_entries:
+                self._evict(self._size - self.max_entries)
+            self._conn.commit()
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(clock, key) for key, clock in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def flush(self):
+        """Write the last_used updates of hits since the last put or flush"""
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+
+    def _evict(self, count):
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (count,)
+        )
+        self.evictions += count
+        self._size -= count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': self._size,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.0%} hit rate), {stats['evictions']} evictions, "
+                f"{stats['entries']} entries")
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
+
+def open_embedding_cache(model_id, dimensions):
+    """Open the cache configured by EMBEDDING_CACHE_PATH, or None when it is set to ''.
+
+    Fake and replayed clients get no cache: their vectors are keyed by the real
+    model id and would otherwise be served to later live runs.
+    """
+    path = os.environ.get('EMBEDDING_CACHE_PATH', os.path.join('.cache', 'embeddings.sqlite'))
+    if not path or not responses_are_live():
+        return None
+    max_entries = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', '500000'))
+    return EmbeddingCache(path, model_id, dimensions, max_entries)
+
+def open_embedder_cache(embedder):
+    """The embedding cache for embedder's model and dimensions, or None when it should not be cached"""
+    # A batch-native (local) embedder is faster than a cache lookup
+    if embedder.batch_native:
+        return None
+    return open_embedding_cache(embedder.model_id, embedder.dimensions)
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import math
+import os
+from collections import Counter
+import numpy as np
+
+TITAN_MODEL_ID = 'amazon.titan-embed-text-v2:0'
+LOCAL_MODEL_ID = 'local-tfidf-svd'
+EMBEDDING_PROVIDERS = ('bedrock', 'local')
+# Texts turned into TF-IDF rows at a time, and the most n-gram x component products held at once
+TRANSFORM_CHUNK = 10000
+SPARSE_CHUNK_VALUES = 1 << 22
+
+class BedrockEmbedder:
+    """Titan text embeddings through bedrock-runtime invoke_model.
+
+    Titan embeds one text per request, so embed() is a loop; callers that need
+    throughput run embed_one concurrently under a rate limiter instead.
+    """
+    batch_native = False
+
+    def __init__(self, client, model_id=TITAN_MODEL_ID, dimensions=1024):
+        self.client = client
+        self.model_id = model_id
+        self.dimensions = dimensions
+
+    def request(self, text):
+        request = {'inputText': text}
+        # 1024 is Titan v2's default; leaving it out keeps recorded cassettes valid
+        if self.dimensions != 1024:
+            request['dimensions'] = self.dimensions
+        return request
+
+    def embed_one(self, text):
+        response = self.client.invoke_model(modelId=self.model_id, body=json.dumps(self.request(text)))
+        return json.loads(response['body'].read())['embedding']
+
+    def embed(self, texts):
+        return [self.embed_one(text) for text in texts]
+
+def char_ngrams(text, ngram_range=(2, 4)):
+    """Character n-grams inside each space-padded word of the lowercased text"""
+    low, high = ngram_range
+    ngrams = []
+    for word in str(text).lower().split():
+        padded = f" {word} "
+        if len(padded) < low:
+            ngrams.append(padded)
+            continue
+        for n in range(low, min(high, len(padded)) + 1):
+            ngrams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return ngrams
+
+def sparse_dot(indptr, indices, data, dense):
+    """(CSR matrix) @ dense, summing row by row in chunks of about SPARSE_CHUNK_VALUES products"""
+    rows = len(indptr) - 1
+    out = np.zeros((rows, dense.shape[1]), dtype=np.float32)
+    budget = max(1, SPARSE_CHUNK_VALUES // max(dense.shape[1], 1))
+    start = 0
+    while start < rows:
+        end = int(np.searchsorted(indptr, indptr[start] + budget, side='right')) - 1
+        end = min(max(end, start + 1), rows)
+        lo, hi = indptr[start], indptr[end]
+        if hi > lo:
+            products = data[lo:hi, None] * dense[indices[lo:hi]]
+            counts = np.diff(indptr[start:end + 1])
+            filled = np.flatnonzero(counts)
+            # reduceat sums each non-empty row's run; empty rows stay zero
+            out[start + filled] = np.add.reduceat(products, indptr[start:end][filled] - lo, axis=0)
+        start = end
+    return out
+
+def transpose_csr(indptr, indices, data, columns):
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    t_indptr = np.concatenate([[0], np.cumsum(np.bincount(indices, minlength=columns))]).astype(np.int64)
+    return t_indptr, rows[order], data[order]
+
+class TfidfSvdEmbedder:
+    """Offline embeddings: character n-gram TF-IDF projected onto SVD components of the standard catalog.
+
+    fit() learns the n-gram vocabulary, IDF weights and the top singular vectors
+    (randomized SVD) from the catalog displays. embed() maps any text to a unit
+    vector in that space with sparse NumPy products, so it needs no network,
+    runs on CPU and handles thousands of texts per second. N-grams not seen in
+    the catalog are ignored. When the catalog supports fewer components than
+    requested, the remaining dimensions are zero so vector sizes still match
+    EMBEDDING_DIMENSIONS.
+    """
+    batch_native = True
+
+    def __init__(self, vocabulary, idf, components, ngram_range=(2, 4)):
+        self.terms = list(vocabulary)
+        self.vocabulary = {term: i for i, term in enumerate(self.terms)}
+        self.idf = np.asarray(idf, dtype=np.float32)
+        # (vocabulary x dimensions); row j is the projection of n-gram j
+        self.components = np.asarray(components, dtype=np.float32)
+        self.ngram_range = tuple(ngram_range)
+        digest = hashlib.sha256(json.dumps([self.terms, list(self.ngram_range)]).encode('utf-8'))
+        digest.update(self.idf.tobytes())
+        digest.update(self.components.tobytes())
+        self.model_id = f"{LOCAL_MODEL_ID}:{digest.hexdigest()[:16]}"
+
+    @property
+    def dimensions(self):
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(cls, texts, dimensions=256, ngram_range=(2, 4), min_df=2, max_features=50000,
+            iterations=4, oversample=10, seed=0):
+        texts = [str(text) for text in texts]
+        document_frequency = Counter()
+        for text in texts:
+            document_frequency.update(set(char_ngrams(text, ngram_range)))
+        kept = sorted((term for term, count in document_frequency.items() if count >= min_df),
+                      key=lambda term: (-document_frequency[term], term))[:max_features]
+        if not kept:
+            raise ValueError("The standard catalog is too small to fit a local embedder")
+        # Smoothed IDF, as if one extra document contained every n-gram
+        idf = np.array([math.log((1 + len(texts)) / (1 + document_frequency[term])) + 1 for term in kept],
+                       dtype=np.float32)
+        model = cls(kept, idf, np.zeros((len(kept), dimensions), dtype=np.float32), ngram_range)
+        indptr, indices, data = model.transform(texts)
+        rank = min(dimensions, len(texts), len(kept))
+        components = randomized_svd(indptr, indices, data, len(kept), rank, iterations, oversample, seed)
+        model = cls(kept, idf, np.pad(components, ((0, 0), (0, dimensions - rank))), ngram_range)
+        print(f"Fitted local embedder on {len(texts)} texts: {len(kept)} n-grams, {rank} components"
+              + (f" (padded to {dimensions})" if rank < dimensions else ""))
+        return model
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            return cls(saved['vocabulary'].tolist(), saved['idf'], saved['components'], saved['ngram_range'].tolist())
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp.npz"
+        np.savez(temp_path, vocabulary=np.array(self.terms), idf=self.idf, components=self.components,
+                 ngram_range=np.array(self.ngram_range))
+        os.replace(temp_path, path)
+
+    def transform(self, texts):
+        """L2-normalized TF-IDF rows (sublinear term frequency) as CSR arrays (indptr, indices, data)"""
+        parts = []
+        for start in range(0, len(texts), TRANSFORM_CHUNK):
+            chunk = texts[start:start + TRANSFORM_CHUNK]
+            row_ids = []
+            columns = []
+            for row, text in enumerate(chunk):
+                for ngram in char_ngrams(text, self.ngram_range):
+                    column = self.vocabulary.get(ngram)
+                    if column is not None:
+                        row_ids.append(row)
+                        columns.append(column)
+            pairs, counts = np.unique(np.array(row_ids, dtype=np.int64) * len(self.terms)
+                                      + np.array(columns, dtype=np.int64), return_counts=True)
+            rows = pairs // len(self.terms)
+            indices = pairs % len(self.terms)
+            data = (1 + np.log(counts)).astype(np.float32) * self.idf[indices]
+            norms = np.sqrt(np.bincount(rows, weights=data.astype(np.float64) ** 2, minlength=len(chunk)))
+            data /= np.maximum(norms[rows], 1e-12).astype(np.float32)
+            parts.append((np.bincount(rows, minlength=len(chunk)), indices, data))
+        if not parts:
+            return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        indptr = np.concatenate([[0], np.cumsum(np.concatenate([part[0] for part in parts]))]).astype(np.int64)
+        return indptr, np.concatenate([part[1] for part in parts]), np.concatenate([part[2] for part in parts])
+
+    def embed_matrix(self, texts):
+        """(len(texts) x dimensions) float32 unit rows; texts with no known n-gram embed as zeros"""
+        vectors = sparse_dot(*self.transform([str(text) for text in texts]), self.components)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def embed(self, texts):
+        return self.embed_matrix(texts).tolist()
+
+    def embed_one(self, text):
+        return self.embed([text])[0]
+
+def randomized_svd(indptr, indices, data, columns, rank, iterations=4, oversample=10, seed=0):
+    """Top right singular vectors (columns x rank) of a CSR matrix, by randomized range finding"""
+    rows = len(indptr) - 1
+    width = min(rank + oversample, rows, columns)
+    transposed = transpose_csr(indptr, indices, data, columns)
+    rng = np.random.default_rng(seed)
+    sample = sparse_dot(indptr, indices, data, rng.standard_normal((columns, width)).astype(np.float32))
+    for _ in range(iterations):
+        basis, _ = np.linalg.qr(sample)
+        projected, _ = np.linalg.qr(sparse_dot(*transposed, basis))
+        sample = sparse_dot(indptr, indices, data, projected)
+    basis, _ = np.linalg.qr(sample)
+    # B = basis.T @ X is small (width x columns); its right singular vectors approximate X's
+    _, _, vt = np.linalg.svd(sparse_dot(*transposed, basis).T, full_matrices=False)
+    return vt[:rank].T.astype(np.float32)
+
+def open_embedder(provider, dimensions, model_path=None, client=None):
+    """The configured provider: Titan through client, or the local model saved at model_path"""
+    if provider == 'bedrock':
+        return BedrockEmbedder(client, TITAN_MODEL_ID, dimensions)
+    if provider == 'local':
+        if not model_path or not os.path.exists(model_path):
+            raise FileNotFoundError(f"Local embedder {model_path} not found; run generate_embeddings.py "
+                                    "with EMBEDDING_PROVIDER=local to fit it on the standard codes")
+        embedder = TfidfSvdEmbedder.load(model_path)
+        if embedder.dimensions != dimensions:
+            raise ValueError(f"Local embedder {model_path} has {embedder.dimensions} dimensions "
+                             f"but EMBEDDING_DIMENSIONS is {dimensions}")
+        return embedder
+    raise ValueError(f"Unknown EMBEDDING_PROVIDER {provider!r}; expected one of {', '.join(EMBEDDING_PROVIDERS)}")
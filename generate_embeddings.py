@@ -1,8 +1,231 @@
 #!/usr/bin/env python3
 import json
-import boto3
+import hashlib
 import pandas as pd
 import os
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from local_index import LocalVectorIndex
+from ann_index import IVFIndex, recall_at_k, sample_queries
+from embedding_cache import open_embedder_cache
+from embedding_providers import TITAN_MODEL_ID, BedrockEmbedder, TfidfSvdEmbedder
+from rate_limiter import AdaptiveRateLimiter, call_with_backoff
+from lexical_index import LexicalIndex
+from aws_clients import make_client
+
+# 's3vectors' uploads to the S3 Vectors index, 'local' writes a memory-mapped index to LOCAL_INDEX_DIR
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 's3vectors')
+LOCAL_INDEX_DIR = os.environ.get('LOCAL_INDEX_DIR', 'local_vector_index')
+# The local index also gets IVF lists for approximate search once it holds ANN_MIN_VECTORS vectors;
+# ANN_NLIST lists (0 picks about sqrt(N)), with recall@30 checked at ANN_NPROBE lists probed
+ANN_MIN_VECTORS = int(os.environ.get('ANN_MIN_VECTORS', '50000'))
+ANN_NLIST = int(os.environ.get('ANN_NLIST', '0'))
+ANN_NPROBE = int(os.environ.get('ANN_NPROBE', '16'))
+# 'bedrock' embeds with Titan; 'local' fits a TF-IDF + SVD embedder on the standard codes and saves
+# it to LOCAL_EMBEDDER_PATH, so mapping can run without network access
+EMBEDDING_PROVIDER = os.environ.get('EMBEDDING_PROVIDER', 'bedrock')
+EMBEDDING_MODEL_ID = TITAN_MODEL_ID
+# Titan v2 output size: 1024, 512 or 256 (any size for the local embedder).
+# The S3 Vectors index is created with 1024 dimensions
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', '1024'))
+# How the local index stores vectors: 'float32', or a compact 'float16' or 'int8' (per-vector scale)
+# copy that queries are scored on before the best candidates are re-ranked with the float32 vectors
+INDEX_STORAGE = os.environ.get('INDEX_STORAGE', 'float32')
+# Ceiling and starting point for concurrent Titan calls; the AIMD limiter adapts between them
+EMBED_CONCURRENCY = int(os.environ.get('EMBED_CONCURRENCY', '16'))
+EMBED_INITIAL_CONCURRENCY = int(os.environ.get('EMBED_INITIAL_CONCURRENCY', '4'))
+BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 500
+# (STANDARD_IDENTIFIER -> content hashes) of the last indexed CSV, used for delta updates
+MANIFEST_PATH = os.environ.get(
+    'INDEX_MANIFEST_PATH',
+    os.path.join(LOCAL_INDEX_DIR, 'manifest.json') if VECTOR_BACKEND == 'local' else 's3vectors_manifest.json'
+)
+# BM25 index over STANDARD_DISPLAY, rebuilt from the full CSV on every run
+LEXICAL_INDEX_PATH = os.environ.get(
+    'LEXICAL_INDEX_PATH',
+    os.path.join(LOCAL_INDEX_DIR, 'lexical_index.json') if VECTOR_BACKEND == 'local' else 'lexical_index.json'
+)
+# Fitted local embedder, refitted from the full CSV on every run with EMBEDDING_PROVIDER=local
+LOCAL_EMBEDDER_PATH = os.environ.get(
+    'LOCAL_EMBEDDER_PATH',
+    os.path.join(LOCAL_INDEX_DIR, 'local_embedder.npz') if VECTOR_BACKEND == 'local' else 'local_embedder.npz'
+)
+
+def make_embedder(df, client=None):
+    """Titan through client, or a local embedder fitted on df's displays (saved once the index is written)"""
+    if EMBEDDING_PROVIDER == 'local':
+        return TfidfSvdEmbedder.fit(df['STANDARD_DISPLAY'].astype(str).tolist(), EMBEDDING_DIMENSIONS)
+    if EMBEDDING_PROVIDER != 'bedrock':
+        raise ValueError(f"Unknown EMBEDDING_PROVIDER {EMBEDDING_PROVIDER!r}; expected 'bedrock' or 'local'")
+    return BedrockEmbedder(client or make_client('bedrock-runtime', "us-east-1"), EMBEDDING_MODEL_ID, EMBEDDING_DIMENSIONS)
+
+def build_ann_index(vector_store):
+    """Cluster the saved local index into IVF lists and check recall@30 against exact search"""
+    if len(vector_store) < ANN_MIN_VECTORS:
+        IVFIndex.remove(LOCAL_INDEX_DIR)
+        return None
+    start = time.time()
+    ann = IVFIndex.build(vector_store, ANN_NLIST or None, ANN_NPROBE)
+    ann.save(LOCAL_INDEX_DIR)
+    queries = sample_queries(vector_store)
+    recall = recall_at_k(ann, vector_store, queries, k=30)
+    print(f"Built IVF index with {ann.nlist} lists in {time.time() - start:.1f}s; "
+          f"recall@30 at nprobe {ANN_NPROBE}: {recall:.3f} over {len(queries)} sample queries")
+    return ann
+
+def build_vector_item(row, vector):
+    """Prepare vector with metadata"""
+    return {
+        'key': str(row['STANDARD_IDENTIFIER']),
+        'data': {'float32': vector},
+        'metadata': {
+            'code': str(row['STANDARD_IDENTIFIER']),
+            'display': str(row['STANDARD_DISPLAY']),
+            'system': str(row['SYSTEM']),
+            'rank': str(row['RANK'])
+        }
+    }
+
+async def embed_with_backoff(text, embed_one, limiter, embedding_cache=None, max_retries=5):
+    """Embed one text, backing off on throttling; cache hits skip the limiter entirely"""
+    if embedding_cache is not None:
+        vector = embedding_cache.get(text)
+        if vector is not None:
+            return vector
+    
+    vector = await call_with_backoff(lambda: asyncio.to_thread(embed_one, text), limiter, max_retries)
+    if embedding_cache is not None:
+        embedding_cache.put(text, vector)
+    return vector
+
+async def ingest_batches(df, embedder, upload_batch, embedding_cache=None):
+    """Embed df in batches of BATCH_SIZE with a concurrent worker pool.
+
+    A batch-native embedder embeds each batch in one call instead. Embedding of
+    batch k+1 overlaps with upload_batch(batch k), which runs in a thread.
+    Returns the number of vectors uploaded.
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY + 1))
+    limiter = AdaptiveRateLimiter(EMBED_CONCURRENCY, EMBED_INITIAL_CONCURRENCY)
+    total_processed = 0
+    upload_task = None
+    start = time.time()
+    
+    for i in range(0, len(df), BATCH_SIZE):
+        batch_df = df.iloc[i:i+BATCH_SIZE]
+        rows = [row for _, row in batch_df.iterrows()]
+        
+        # Embed STANDARD_DISPLAY
+        if embedder.batch_native:
+            vectors = await asyncio.to_thread(embedder.embed, [row['STANDARD_DISPLAY'] for row in rows])
+        else:
+            vectors = await asyncio.gather(*(
+                embed_with_backoff(row['STANDARD_DISPLAY'], embedder.embed_one, limiter, embedding_cache)
+                for row in rows
+            ))
+        vectors_batch = [build_vector_item(row, vector) for row, vector in zip(rows, vectors)]
+        
+        # Wait for the previous upload before starting this one so batches land in order
+        if upload_task is not None:
+            total_processed += await upload_task
+            elapsed = time.time() - start
+            print(f"Processed batch {i//BATCH_SIZE}, total vectors: {total_processed} "
+                  f"({total_processed / elapsed:.1f} vectors/s, {limiter.summary()})")
+        upload_task = asyncio.create_task(asyncio.to_thread(upload_batch, vectors_batch))
+    
+    if upload_task is not None:
+        total_processed += await upload_task
+        elapsed = time.time() - start
+        print(f"Processed batch {(len(df) + BATCH_SIZE - 1)//BATCH_SIZE}, total vectors: {total_processed} "
+              f"({total_processed / elapsed:.1f} vectors/s, {limiter.summary()})")
+    return total_processed
+
+def code_hashes(row):
+    """(hash of the embedded text, hash of everything stored for the code)"""
+    display = str(row['STANDARD_DISPLAY'])
+    embed_hash = hashlib.sha256(display.encode('utf-8')).hexdigest()[:16]
+    metadata = json.dumps([display, str(row['SYSTEM']), str(row['RANK'])])
+    metadata_hash = hashlib.sha256(metadata.encode('utf-8')).hexdigest()[:16]
+    return [embed_hash, metadata_hash]
+
+def build_manifest(df, embedder):
+    return {
+        'model': embedder.model_id,
+        'dimensions': embedder.dimensions,
+        'codes': {str(row['STANDARD_IDENTIFIER']): code_hashes(row) for _, row in df.iterrows()}
+    }
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+def manifest_matches(manifest, embedder):
+    """Delta updates need the previous index to hold vectors from the same model and dimensions"""
+    return manifest.get('model') == embedder.model_id and manifest.get('dimensions') == embedder.dimensions
+
+def save_manifest(manifest):
+    if os.path.dirname(MANIFEST_PATH):
+        os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f)
+
+def diff_manifest(new_manifest, old_manifest):
+    """Split codes into (to embed, metadata-only refresh, removed) against the previous manifest"""
+    old_codes = old_manifest['codes']
+    to_embed, to_refresh = set(), set()
+    for key, (embed_hash, metadata_hash) in new_manifest['codes'].items():
+        old = old_codes.get(key)
+        if old is None or old[0] != embed_hash:
+            to_embed.add(key)
+        elif old[1] != metadata_hash:
+            to_refresh.add(key)
+    removed = [key for key in old_codes if key not in new_manifest['codes']]
+    return to_embed, to_refresh, removed
+
+def refresh_metadata(vector_store, refresh_df, vector_bucket_name, index_name):
+    """Re-put codes whose metadata changed, reusing their stored vectors instead of re-embedding"""
+    for i in range(0, len(refresh_df), BATCH_SIZE):
+        batch_df = refresh_df.iloc[i:i+BATCH_SIZE]
+        rows = {str(row['STANDARD_IDENTIFIER']): row for _, row in batch_df.iterrows()}
+        stored = vector_store.get_vectors(
+            vectorBucketName=vector_bucket_name,
+            indexName=index_name,
+            keys=list(rows),
+            returnData=True
+        )
+        vector_store.put_vectors(
+            vectorBucketName=vector_bucket_name,
+            indexName=index_name,
+            vectors=[build_vector_item(rows[item['key']], item['data']['float32']) for item in stored['vectors']]
+        )
+
+def stale_keys(vector_store, codes, vector_bucket_name, index_name):
+    """Keys stored in the index that are not among codes, listed page by page"""
+    keys = []
+    next_token = None
+    while True:
+        page = vector_store.list_vectors(
+            vectorBucketName=vector_bucket_name,
+            indexName=index_name,
+            maxResults=1000,
+            **({'nextToken': next_token} if next_token else {})
+        )
+        keys.extend(item['key'] for item in page.get('vectors', []) if item['key'] not in codes)
+        next_token = page.get('nextToken')
+        if not next_token:
+            return keys
+
+def delete_codes(vector_store, keys, vector_bucket_name, index_name):
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        vector_store.delete_vectors(
+            vectorBucketName=vector_bucket_name,
+            indexName=index_name,
+            keys=keys[i:i+DELETE_BATCH_SIZE]
+        )
 
 def process_vectors():
     # Get file path from user with retry
@@ -24,61 +247,85 @@ def process_vectors():
         break
     
     # Initialize clients
-    bedrock_client = boto3.client('bedrock-runtime', region_name="us-east-1")
-    s3vectors = boto3.client("s3vectors", region_name="us-east-1")
+    if VECTOR_BACKEND == 'local':
+        vector_store = None
+    else:
+        vector_store = make_client("s3vectors", "us-east-1")
     
     vector_bucket_name = 'code-mapping-vector-bucket'
     index_name = 'code-mapping-vector-index'
     
+    def upload_batch(vectors_batch):
+        # Insert batch into vector index
+        vector_store.put_vectors(
+            vectorBucketName=vector_bucket_name,
+            indexName=index_name,
+            vectors=vectors_batch
+        )
+        return len(vectors_batch)
+    
     try:
         # Read CSV from local file
         df = pd.read_csv(file_path)
         print(f"Read CSV with {len(df)} rows")
         
-        # Process data in batches of 100
-        batch_size = 100
-        total_processed = 0
+        # A refitted local embedder has a new model id, so its manifest check forces a full rebuild
+        embedder = make_embedder(df)
+        embedding_cache = open_embedder_cache(embedder)
+        
+        # Offer a delta update when a manifest from a previous run exists
+        new_manifest = build_manifest(df, embedder)
+        old_manifest = load_manifest()
+        delta = False
+        if old_manifest is not None and not manifest_matches(old_manifest, embedder):
+            print("Manifest was built with a different embedding model; a full rebuild is required")
+        elif old_manifest is not None:
+            answer = input(f"Found an index manifest with {len(old_manifest['codes'])} codes. "
+                           "Only re-index new, changed and removed codes? (y/n): ")
+            delta = answer.strip().lower() == 'y'
+        
+        if VECTOR_BACKEND == 'local':
+            vector_store = LocalVectorIndex.load(LOCAL_INDEX_DIR, mmap=False) if delta else LocalVectorIndex.empty()
+        
+        start = time.time()
+        if delta:
+            to_embed, to_refresh, removed = diff_manifest(new_manifest, old_manifest)
+            identifiers = df['STANDARD_IDENTIFIER'].astype(str)
+            embed_df = df[identifiers.isin(to_embed)]
+            refresh_df = df[identifiers.isin(to_refresh)]
+            print(f"Delta update: {len(embed_df)} new or changed codes to embed, "
+                  f"{len(refresh_df)} metadata-only updates, {len(removed)} removed codes")
+        else:
+            embed_df = df
+            refresh_df = df.iloc[0:0]
+            removed = []
+        
+        total_processed = asyncio.run(ingest_batches(embed_df, embedder, upload_batch, embedding_cache))
+        refresh_metadata(vector_store, refresh_df, vector_bucket_name, index_name)
+        if not delta and VECTOR_BACKEND != 'local':
+            # A full rebuild overwrites every code in the CSV; whatever else the index holds (codes
+            # dropped since the last run, or vectors from another model) is cleared, manifest or not
+            removed = stale_keys(vector_store, new_manifest['codes'], vector_bucket_name, index_name)
+            if removed:
+                print(f"Deleting {len(removed)} codes from the index that are not in the CSV")
+        delete_codes(vector_store, removed, vector_bucket_name, index_name)
         
-        for i in range(0, len(df), batch_size):
-            batch_df = df.iloc[i:i+batch_size]
-            vectors_batch = []
-            
-            for _, row in batch_df.iterrows():
-                # Embed STANDARD_DISPLAY using Titan
-                embedding_response = bedrock_client.invoke_model(
-                    modelId='amazon.titan-embed-text-v2:0',
-                    body=json.dumps({
-                        'inputText': row['STANDARD_DISPLAY']
-                    })
-                )
-                
-                embedding_data = json.loads(embedding_response['body'].read())
-                vector = embedding_data['embedding']
-                
-                # Prepare vector with metadata
-                vector_item = {
-                    'key': str(row['STANDARD_IDENTIFIER']),
-                    'data': {'float32': vector},
-                    'metadata': {
-                        'code': str(row['STANDARD_IDENTIFIER']),
-                        'display': str(row['STANDARD_DISPLAY']),
-                        'system': str(row['SYSTEM']),
-                        'rank': str(row['RANK'])
-                    }
-                }
-                vectors_batch.append(vector_item)
-            
-            # Insert batch into vector index
-            s3vectors.put_vectors(
-                vectorBucketName=vector_bucket_name,
-                indexName=index_name,
-                vectors=vectors_batch
-            )
-            
-            total_processed += len(vectors_batch)
-            print(f"Processed batch {i//batch_size + 1}, total vectors: {total_processed}")
+        if VECTOR_BACKEND == 'local':
+            vector_store.save(LOCAL_INDEX_DIR, INDEX_STORAGE)
+            print(f"Saved local vector index to {LOCAL_INDEX_DIR} ({INDEX_STORAGE} storage)")
+            build_ann_index(vector_store)
+        if EMBEDDING_PROVIDER == 'local':
+            embedder.save(LOCAL_EMBEDDER_PATH)
+            print(f"Saved local embedder to {LOCAL_EMBEDDER_PATH}")
+        save_manifest(new_manifest)
+        LexicalIndex.from_items([build_vector_item(row, None) for _, row in df.iterrows()]).save(LEXICAL_INDEX_PATH)
+        print(f"Saved lexical index to {LEXICAL_INDEX_PATH}")
         
-        print(f"Successfully processed {total_processed} vectors")
+        print(f"Successfully processed {total_processed} vectors in {time.time() - start:.1f}s "
+              f"({len(refresh_df)} metadata refreshes, {len(removed)} deletions)")
+        if embedding_cache is not None:
+            embedding_cache.flush()
+            print(embedding_cache.summary())
         
     except Exception as e:
         import traceback
@@ -0,0 +1,112 @@
+import heapq
+import json
+import math
+import os
+import re
+from collections import Counter
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).casefold())
+
+class LexicalIndex:
+    """BM25 inverted index over STANDARD_DISPLAY.
+
+    Besides ranked search it answers exact matches on the token sequence, which
+    create_mapping.py uses to skip embedding for displays that already appear
+    verbatim (up to case and punctuation) in the standard catalog.
+    """
+
+    def __init__(self, keys, metadata, postings, doc_lengths, k1=1.2, b=0.75):
+        self.keys = keys
+        self.metadata = metadata
+        self.postings = postings
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+        self._exact = {}
+        for doc_id, meta in enumerate(metadata):
+            self._exact.setdefault(" ".join(tokenize(meta.get('display', ''))), []).append(doc_id)
+
+    @classmethod
+    def from_items(cls, vector_items):
+        """Build from put_vectors style items; only the metadata is used"""
+        keys, metadata, doc_lengths = [], [], []
+        postings = {}
+        positions = {}
+        for item in vector_items:
+            # Later items replace earlier ones with the same key, as in the vector index
+            if item['key'] in positions:
+                metadata[positions[item['key']]] = item['metadata']
+                continue
+            positions[item['key']] = len(keys)
+            keys.append(item['key'])
+            metadata.append(item['metadata'])
+        for doc_id, meta in enumerate(metadata):
+            tokens = tokenize(meta.get('display', ''))
+            doc_lengths.append(len(tokens))
+            for token, tf in Counter(tokens).items():
+                postings.setdefault(token, []).append([doc_id, tf])
+        return cls(keys, metadata, postings, doc_lengths)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['keys'], data['metadata'], data['postings'], data['doc_lengths'])
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                'keys': self.keys,
+                'metadata': self.metadata,
+                'postings': self.postings,
+                'doc_lengths': self.doc_lengths
+            }, f)
+
+    def _result(self, doc_id, distance, score):
+        return {'key': self.keys[doc_id], 'distance': distance, 'score': score, 'metadata': self.metadata[doc_id]}
+
+    def search(self, text, top_k=30):
+        """BM25 top-k as [{'key', 'distance', 'score', 'metadata'}].
+
+        distance is 1 - score / best score, so results can sit next to vector
+        candidates; it is not a cosine distance.
+        """
+        scores = {}
+        n_docs = len(self.keys)
+        # Sorted so scores, and therefore ties, do not depend on string hash order
+        for token in sorted(set(tokenize(text))):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        top = heapq.nsmallest(top_k, scores.items(), key=lambda entry: (-entry[1], entry[0]))
+        if not top:
+            return []
+        best = top[0][1]
+        return [self._result(doc_id, 1.0 - score / best, score) for doc_id, score in top]
+
+    def exact_matches(self, text):
+        """Codes whose display has exactly the same tokens in the same order as text"""
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        return [self._result(doc_id, 0.0, None) for doc_id in self._exact.get(" ".join(tokens), [])]
+
+def reciprocal_rank_fusion(result_lists, top_k=30, k=60):
+    """Merge ranked candidate lists by summed 1 / (k + rank), keeping the first copy of each key"""
+    fused = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, 1):
+            entry = fused.setdefault(result['key'], [0.0, result])
+            entry[0] += 1.0 / (k + rank)
+    ranked = sorted(fused.values(), key=lambda entry: entry[0], reverse=True)
+    return [result for _, result in ranked[:top_k]]
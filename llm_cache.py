@@ -0,0 +1,101 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from aws_clients import responses_are_live
+
+class LLMCache:
+    """Persistent cache of Claude responses.
+
+    Entries are keyed by (model id, instructions hash, exact prompt). The
+    instructions hash doubles as the entry version, so editing the Agent
+    instructions or a prompt template misses the old entries, and purge_stale()
+    removes them. Entries older than ttl_seconds are treated as misses.
+    """
+
+    def __init__(self, path, ttl_seconds=None):
+        self.ttl_seconds = ttl_seconds
+        self.call_stats = {}
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, call_type TEXT NOT NULL, version TEXT NOT NULL, "
+            "response TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def version(instructions):
+        return hashlib.sha256((instructions or '').encode('utf-8')).hexdigest()[:16]
+
+    def key(self, model_id, instructions, prompt):
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return f"{model_id}:{self.version(instructions)}:{digest}"
+
+    def _count(self, call_type, outcome):
+        stats = self.call_stats.setdefault(call_type, {'hits': 0, 'misses': 0})
+        stats[outcome] += 1
+
+    def get(self, call_type, model_id, instructions, prompt):
+        key = self.key(model_id, instructions, prompt)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl_seconds and time.time() - row[1] > self.ttl_seconds):
+                self._count(call_type, 'misses')
+                return None
+            self._count(call_type, 'hits')
+        return row[0]
+
+    def put(self, call_type, model_id, instructions, prompt, response):
+        key = self.key(model_id, instructions, prompt)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, call_type, version, response, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, call_type, self.version(instructions), response, time.time())
+            )
+            self._conn.commit()
+
+    def purge_stale(self, call_type, instructions):
+        """Delete entries of call_type written under different instructions or past the TTL"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM responses WHERE call_type = ? AND version != ?",
+                (call_type, self.version(instructions))
+            )
+            removed = cursor.rowcount
+            if self.ttl_seconds:
+                cursor = self._conn.execute(
+                    "DELETE FROM responses WHERE call_type = ? AND created_at < ?",
+                    (call_type, time.time() - self.ttl_seconds)
+                )
+                removed += cursor.rowcount
+            self._conn.commit()
+        return removed
+
+    def summary(self):
+        parts = [
+            f"{call_type} {stats['hits']} hits/{stats['misses']} misses"
+            for call_type, stats in sorted(self.call_stats.items())
+        ]
+        return "LLM cache: " + (", ".join(parts) if parts else "no lookups")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def open_llm_cache():
+    """Open the cache configured by LLM_CACHE_PATH, or None when it is set to '' or clients are fake or replayed"""
+    path = os.environ.get('LLM_CACHE_PATH', os.path.join('.cache', 'llm_responses.sqlite'))
+    if not path or not responses_are_live():
+        return None
+    ttl_days = float(os.environ.get('LLM_CACHE_TTL_DAYS', '30'))
+    return LLMCache(path, ttl_days * 86400 if ttl_days > 0 else None)
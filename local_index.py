@@ -0,0 +1,256 @@
+import json
+import os
+import numpy as np
+from string_table import TABLE_FILE, load_table, save_table
+
+VECTORS_FILE = 'vectors.npy'
+# Legacy per-vector metadata dicts; indexes are now saved as a columnar string table
+METADATA_FILE = 'metadata.json'
+SCALES_FILE = 'scales.npy'
+# float32 keeps only the exact vectors; float16 and int8 (with a per-vector scale) add a compact copy
+# that queries are scored on before the best candidates are re-ranked with the exact vectors
+STORAGE_TYPES = ('float32', 'float16', 'int8')
+# Compact rows scored per matrix product, to bound temporary memory
+SCORE_CHUNK = 16384
+
+class LocalVectorIndex:
+    """In-process cosine index over the standard code embeddings.
+
+    Besides query_vectors it answers put_vectors, get_vectors, list_vectors and
+    delete_vectors like the s3vectors client, so generate_embeddings.py can write to either.
+    Writes are buffered and merged into the matrix on the next read or save.
+
+    An index saved with float16 or int8 storage is searched on its compact
+    copy; the best top_k * rerank_factor candidates are then re-scored with
+    the exact float32 vectors, which are memory-mapped and only read for them.
+    """
+
+    def __init__(self, vectors, keys, metadata, compact=None, scales=None, rerank_factor=4):
+        self.vectors = vectors
+        self.keys = keys
+        self.metadata = metadata
+        self.compact = compact
+        self.scales = scales
+        self.rerank_factor = rerank_factor
+        # key -> (vector, metadata) to upsert, or None to delete
+        self._pending = {}
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 0), dtype=np.float32), [], [])
+
+    @classmethod
+    def from_items(cls, vector_items):
+        """Build an index from put_vectors style items ({'key', 'data', 'metadata'})"""
+        index = cls.empty()
+        index.put_vectors(vectors=vector_items)
+        index._apply_pending()
+        return index
+
+    @classmethod
+    def load(cls, index_dir, mmap=True, rerank_factor=4):
+        """Load a saved index, memory-mapping the vectors and string table by default"""
+        mmap_mode = 'r' if mmap else None
+        vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode=mmap_mode)
+        if not os.path.exists(os.path.join(index_dir, TABLE_FILE)):
+            with open(os.path.join(index_dir, METADATA_FILE)) as f:
+                table = json.load(f)
+            return cls(vectors, table['keys'], table['metadata'], rerank_factor=rerank_factor)
+        keys, metadata, table = load_table(index_dir, mmap)
+        storage = table.get('storage', 'float32')
+        compact = scales = None
+        if storage != 'float32':
+            compact = np.load(os.path.join(index_dir, f'vectors_{storage}.npy'), mmap_mode=mmap_mode)
+            if storage == 'int8':
+                scales = np.load(os.path.join(index_dir, SCALES_FILE), mmap_mode=mmap_mode)
+        return cls(vectors, keys, metadata, compact, scales, rerank_factor)
+
+    def save(self, index_dir, storage='float32'):
+        """Write the exact vectors, a compact copy for float16 or int8 storage, and the string table"""
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown index storage {storage!r}; expected one of {', '.join(STORAGE_TYPES)}")
+        self._apply_pending()
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, VECTORS_FILE), np.ascontiguousarray(self.vectors, dtype=np.float32))
+        for name in [f'vectors_{other}.npy' for other in STORAGE_TYPES[1:]] + [SCALES_FILE, METADATA_FILE]:
+            if os.path.exists(os.path.join(index_dir, name)):
+                os.remove(os.path.join(index_dir, name))
+        if storage != 'float32':
+            self.compact, self.scales = quantize(self.vectors, storage)
+            np.save(os.path.join(index_dir, f'vectors_{storage}.npy'), self.compact)
+            if self.scales is not None:
+                np.save(os.path.join(index_dir, SCALES_FILE), self.scales)
+        save_table(index_dir, self.keys, self.metadata, storage=storage)
+
+    def __len__(self):
+        self._apply_pending()
+        return len(self.keys)
+
+    def put_vectors(self, vectors, **kwargs):
+        for item in vectors:
+            self._pending[item['key']] = (item['data']['float32'], item['metadata'])
+
+    def delete_vectors(self, keys, **kwargs):
+        for key in keys:
+            self._pending[key] = None
+
+    def get_vectors(self, keys, returnData=False, returnMetadata=False, **kwargs):
+        self._apply_pending()
+        positions = {key: i for i, key in enumerate(self.keys)}
+        results = []
+        for key in keys:
+            i = positions.get(key)
+            if i is None:
+                continue
+            result = {'key': key}
+            if returnData:
+                result['data'] = {'float32': self.vectors[i].tolist()}
+            if returnMetadata:
+                result['metadata'] = self.metadata[i]
+            results.append(result)
+        return {'vectors': results}
+
+    def list_vectors(self, maxResults=500, nextToken=None, **kwargs):
+        """One page of stored keys; nextToken is the position of the next page"""
+        self._apply_pending()
+        start = int(nextToken or 0)
+        page = {'vectors': [{'key': key} for key in self.keys[start:start + maxResults]]}
+        if start + maxResults < len(self.keys):
+            page['nextToken'] = str(start + maxResults)
+        return page
+
+    def _apply_pending(self):
+        if not self._pending:
+            return
+        # The compact copy is rebuilt on save; until then queries use the exact vectors
+        self.compact = self.scales = None
+        self.keys = list(self.keys)
+        self.metadata = list(self.metadata)
+        positions = {key: i for i, key in enumerate(self.keys)}
+        vectors = np.array(self.vectors, dtype=np.float32)
+        keep = np.ones(len(self.keys), dtype=bool)
+        new_keys, new_vectors, new_metadata = [], [], []
+        for key, value in self._pending.items():
+            i = positions.get(key)
+            if value is None:
+                if i is not None:
+                    keep[i] = False
+            elif i is not None:
+                vectors[i] = normalize_rows(np.asarray(value[0], dtype=np.float32).reshape(1, -1))[0]
+                self.metadata[i] = value[1]
+            else:
+                new_keys.append(key)
+                new_vectors.append(value[0])
+                new_metadata.append(value[1])
+        self._pending = {}
+
+        keys = [key for key, kept in zip(self.keys, keep) if kept]
+        metadata = [meta for meta, kept in zip(self.metadata, keep) if kept]
+        vectors = vectors[keep]
+        if new_keys:
+            added = normalize_rows(np.array(new_vectors, dtype=np.float32))
+            vectors = np.vstack([vectors, added]) if len(keys) else added
+        self.vectors = vectors
+        self.keys = keys + new_keys
+        self.metadata = metadata + new_metadata
+
+    def query(self, vector, top_k=30):
+        """Exact cosine top-k, returned best first as [{'key', 'distance', 'metadata'}]"""
+        return self.query_batch(np.asarray(vector, dtype=np.float32).reshape(1, -1), top_k)[0]
+
+    def query_batch(self, matrix, top_k=30):
+        """Cosine top-k for every row of an (N x dim) query matrix, exact unless the index is compact"""
+        self._apply_pending()
+        queries = normalize_rows(np.asarray(matrix, dtype=np.float32).reshape(len(matrix), -1))
+        if self.compact is not None:
+            return self._query_compact(queries, top_k)
+        scores = queries @ self.vectors.T
+        top_k = min(top_k, scores.shape[1])
+        if top_k == 0 or len(queries) == 0:
+            return [[] for _ in range(len(queries))]
+        top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        distances = 1.0 - np.take_along_axis(top_scores, order, axis=1)
+        return [
+            [
+                {
+                    'key': self.keys[i],
+                    'distance': float(distance),
+                    'metadata': self.metadata[i]
+                }
+                for i, distance in zip(row_ids, row_distances)
+            ]
+            for row_ids, row_distances in zip(top, distances)
+        ]
+
+    def _query_compact(self, queries, top_k):
+        candidate_count = min(top_k * self.rerank_factor, len(self.keys))
+        if candidate_count == 0 or len(queries) == 0:
+            return [[] for _ in range(len(queries))]
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.keys), SCORE_CHUNK):
+            end = min(start + SCORE_CHUNK, len(self.keys))
+            scales = self.scales[start:end] if self.scales is not None else None
+            scores = np.hstack([best_scores, score_rows(self.compact[start:end], scales, queries)])
+            ids = np.hstack([best_ids, np.broadcast_to(np.arange(start, end), (len(queries), end - start))])
+            if scores.shape[1] > candidate_count:
+                top = np.argpartition(-scores, candidate_count - 1, axis=1)[:, :candidate_count]
+                scores = np.take_along_axis(scores, top, axis=1)
+                ids = np.take_along_axis(ids, top, axis=1)
+            best_scores, best_ids = scores, ids
+        return [self.results(ids, scores) for ids, scores in exact_rerank(self.vectors, queries, best_ids, top_k)]
+
+    def results(self, ids, scores):
+        """Result dicts for row ids and their cosine similarities, best first"""
+        return [{'key': self.keys[i], 'distance': float(1.0 - score), 'metadata': self.metadata[i]}
+                for i, score in zip(ids, scores)]
+
+    def query_vectors(self, queryVector, topK=30, returnDistance=True, returnMetadata=True, **kwargs):
+        """Same call shape and response as s3vectors.query_vectors"""
+        results = self.query(queryVector['float32'], topK)
+        for result in results:
+            if not returnDistance:
+                del result['distance']
+            if not returnMetadata:
+                del result['metadata']
+        return {'vectors': results}
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def quantize(vectors, storage):
+    """Compact copy of unit vectors as (matrix, per-vector scales or None)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if storage == 'float16':
+        return vectors.astype(np.float16), None
+    if storage == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127.0 if len(vectors) else np.zeros(0, dtype=np.float32)
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    raise ValueError(f"No compact form for {storage!r} storage")
+
+def score_rows(rows, scales, queries):
+    """Approximate (N queries x rows) cosine similarities from a block of compact rows"""
+    scores = queries @ np.asarray(rows, dtype=np.float32).T
+    if scales is not None:
+        scores *= np.asarray(scales, dtype=np.float32)
+    return scores
+
+def exact_rerank(vectors, queries, candidates, top_k):
+    """Re-score each query's candidate row ids with the exact vectors; yields (ids, scores) best first"""
+    for query, ids in zip(queries, candidates):
+        # Sorted ids read the memory-mapped matrix in file order
+        ids = np.sort(np.asarray(ids, dtype=np.int64))
+        scores = np.asarray(vectors[ids], dtype=np.float32) @ query
+        k = min(top_k, len(ids))
+        if k == 0:
+            yield ids[:0], scores[:0]
+            continue
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        yield ids[top], scores[top]
@@ -0,0 +1,128 @@
+import json
+import os
+import time
+import pandas as pd
+
+class MappingJournal:
+    """Append-only JSONL journal of completed mapping rows.
+
+    The first line records the input file the run belongs to. Each later line is
+    {"seq": <input row index>, "row": <mapping row>}. Lines are flushed as they are
+    written and fsynced every fsync_every rows or fsync_interval seconds, so a
+    crash loses at most the last unsynced rows.
+    """
+
+    def __init__(self, path, fsync_every=20, fsync_interval=2.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def read(self):
+        """Return (input_path, [(seq, row), ...]); a truncated last line is ignored"""
+        if not os.path.exists(self.path):
+            return None, []
+        input_path = None
+        entries = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if 'input' in record:
+                    input_path = record['input']
+                else:
+                    entries.append((record['seq'], record['row']))
+        return input_path, entries
+
+    def completed_seqs(self):
+        return {seq for seq, _ in self.read()[1]}
+
+    def start(self, input_path, resume):
+        """Open the journal for a run, keeping its entries only when resuming"""
+        if resume:
+            self._truncate_partial_line()
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+            self._file.write(json.dumps({'input': os.path.abspath(input_path)}) + '\n')
+            self._sync()
+
+    def _truncate_partial_line(self):
+        # Drop a half-written last line so new entries start on a fresh line
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def append(self, seq, row):
+        self._file.write(json.dumps({'seq': seq, 'row': row}) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    def compact(self, output_path, chunk_size=10000):
+        """Write the journal to the mapping CSV layout in input order; returns the row count"""
+        return compact_journals([self.path], output_path, chunk_size)
+
+def compact_journals(paths, output_path, chunk_size=10000):
+    """Write the mapping rows of one or more journals to a CSV in input order; returns the row count.
+
+    Entries are keyed by seq, so rows sharing a code (or with no code) each keep
+    their own output row; a row mapped more than once keeps its last entry,
+    later journals winning. Only the file offset of each row's entry is held in
+    memory; rows are read back and written chunk_size at a time.
+    """
+    latest = {}
+    columns = {}
+    for file_id, path in enumerate(paths):
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if 'row' in record:
+                    latest[record['seq']] = (record['seq'], file_id, offset)
+                    columns.update(dict.fromkeys(record['row']))
+                offset += len(line)
+    entries = sorted(latest.values())
+    if not entries:
+        pd.DataFrame([]).to_csv(output_path, index=False)
+        return 0
+    
+    files = {}
+    try:
+        for start in range(0, len(entries), chunk_size):
+            rows = []
+            for _, file_id, offset in entries[start:start + chunk_size]:
+                if file_id not in files:
+                    files[file_id] = open(paths[file_id], 'rb')
+                files[file_id].seek(offset)
+                rows.append(json.loads(files[file_id].readline())['row'])
+            pd.DataFrame(rows, columns=list(columns)).to_csv(
+                output_path, index=False, header=start == 0, mode='w' if start == 0 else 'a'
+            )
+    finally:
+        for f in files.values():
+            f.close()
+    return len(entries)
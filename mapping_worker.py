@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Long-lived mapping worker that keeps clients, indexes, caches and the agent warm.
+
+Requests are JSON objects: {"id": <any>, "rows": [<row>, ...]} or a single row,
+where a row has the input CSV columns (proprietary_code, proprietary_display,
+type, average, categories). Responses are {"id": ..., "mappings": [...]} or
+{"id": ..., "error": "..."}.
+
+With WORKER_HTTP_PORT unset, requests are read as JSON lines from stdin and
+responses written as JSON lines to stdout, in completion order; log output goes
+to stderr. With WORKER_HTTP_PORT set, requests are POSTed to /map, and GET
+/health reports readiness.
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORKER_HTTP_HOST = os.environ.get('WORKER_HTTP_HOST', '127.0.0.1')
+WORKER_HTTP_PORT = os.environ.get('WORKER_HTTP_PORT', '')
+
+class MappingWorker:
+    """Runs create_mapping on one background event loop shared by every request"""
+
+    def __init__(self):
+        import create_mapping
+        self.mapper = create_mapping
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        self.limiter = create_mapping.AdaptiveRateLimiter(
+            create_mapping.MAPPING_CONCURRENCY, create_mapping.MAPPING_INITIAL_CONCURRENCY
+        )
+
+    def warm_up(self):
+        """Build clients, indexes, caches and agents now instead of on the first request"""
+        mapper = self.mapper
+        for get in (mapper.get_bedrock, mapper.get_vector_store, mapper.get_embedder, mapper.get_embedding_cache,
+                    mapper.get_llm_cache, mapper.get_lexical_index, mapper.get_agent, mapper.get_executor):
+            get()
+        if mapper.RANKING_BATCH_SIZE > 1:
+            mapper.get_batch_agent()
+
+    @staticmethod
+    def parse_request(request):
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        rows = request['rows'] if 'rows' in request else [request]
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("rows must be a list of objects")
+        for row in rows:
+            if not row.get('proprietary_display'):
+                raise ValueError("every row needs a proprietary_display")
+        return rows
+
+    def submit(self, request):
+        """Schedule a request; returns a concurrent.futures.Future of the response"""
+        async def handle():
+            try:
+                rows = self.parse_request(request)
+                mappings = await self.mapper.map_records(rows, self.limiter)
+                return {'id': request.get('id'), 'mappings': mappings}
+            except Exception as e:
+                request_id = request.get('id') if isinstance(request, dict) else None
+                return {'id': request_id, 'error': str(e)}
+        return asyncio.run_coroutine_threadsafe(handle(), self.loop)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+def serve_stdin(worker, output):
+    """Read JSONL requests until EOF, answering each as soon as it completes"""
+    write_lock = threading.Lock()
+    pending = []
+
+    def respond(response):
+        with write_lock:
+            output.write(json.dumps(response, default=str) + '\n')
+            output.flush()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            respond({'id': None, 'error': f"invalid JSON: {e}"})
+            continue
+        future = worker.submit(request)
+        future.add_done_callback(lambda done: respond(done.result()))
+        pending.append(future)
+    for future in pending:
+        future.result()
+
+def serve_http(worker, host, port):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload, default=str).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok'})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/map':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except json.JSONDecodeError as e:
+                self._send(400, {'id': None, 'error': f"invalid JSON: {e}"})
+                return
+            response = worker.submit(request).result()
+            self._send(400 if 'error' in response else 200, response)
+
+        def log_message(self, format, *args):
+            print(f"{self.address_string()} {format % args}", file=sys.stderr)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Mapping worker listening on http://{host}:{port}/map", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    # Responses own stdout in JSONL mode; everything the mapper prints goes to stderr
+    output = sys.stdout
+    sys.stdout = sys.stderr
+    worker = MappingWorker()
+    worker.warm_up()
+    print("Mapping worker ready", file=sys.stderr)
+    try:
+        if WORKER_HTTP_PORT:
+            serve_http(worker, WORKER_HTTP_HOST, int(WORKER_HTTP_PORT))
+        else:
+            serve_stdin(worker, output)
+    finally:
+        worker.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+_DONE = object()
+
+class Stage:
+    """One step of a streaming pipeline.
+
+    handler is a coroutine function called with one item (or, when batch_size > 1,
+    with a list of up to batch_size items). A batch is whatever is already queued
+    after the first item arrives, plus whatever arrives within batch_wait seconds.
+    It returns the item(s) to pass downstream; None or an empty list drops them.
+    """
+
+    def __init__(self, name, handler, concurrency=1, batch_size=1, batch_wait=0.0):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+
+    def summary(self):
+        return (f"{self.name}: {self.processed} processed, {self.dropped} dropped, "
+                f"{self.errors} errors, {self.busy_seconds:.1f}s busy")
+
+async def _take_batch(queue, batch_size, batch_wait=0.0):
+    """Wait for one item, then take up to batch_size - 1 more queued within batch_wait seconds"""
+    first = await queue.get()
+    if first is _DONE:
+        return [], True
+    batch = [first]
+    deadline = time.monotonic() + batch_wait
+    while len(batch) < batch_size:
+        try:
+            item = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+        if item is _DONE:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+async def _run_stage(stage, inbox, outbox):
+    async def worker():
+        while True:
+            batch, done = await _take_batch(inbox, stage.batch_size, stage.batch_wait)
+            if batch:
+                start = time.perf_counter()
+                try:
+                    if stage.batch_size > 1:
+                        outputs = await stage.handler(batch) or []
+                    else:
+                        output = await stage.handler(batch[0])
+                        outputs = [] if output is None else [output]
+                except Exception as e:
+                    print(f"  {stage.name} stage error: {e}")
+                    stage.errors += len(batch)
+                    outputs = []
+                stage.busy_seconds += time.perf_counter() - start
+                stage.processed += len(batch)
+                stage.dropped += len(batch) - len(outputs)
+                for output in outputs:
+                    await outbox.put(output)
+            if done:
+                return
+
+    await asyncio.gather(*(worker() for _ in range(stage.concurrency)))
+    # Each downstream worker stops on its own sentinel
+    for _ in range(outbox.concurrency):
+        await outbox.put(_DONE)
+
+class _StageQueue(asyncio.Queue):
+    def __init__(self, maxsize, concurrency):
+        super().__init__(maxsize)
+        self.concurrency = concurrency
+
+async def run_pipeline(source, stages, sink, queue_size=64):
+    """Stream items from source through stages, calling sink(item) on each final output.
+
+    Stages are connected by bounded queues, so a slow stage applies backpressure
+    all the way back to the source instead of letting work pile up in memory.
+    """
+    queues = [_StageQueue(queue_size, stage.concurrency) for stage in stages]
+    queues.append(_StageQueue(queue_size, 1))
+
+    async def produce():
+        for item in source:
+            await queues[0].put(item)
+        for _ in range(stages[0].concurrency):
+            await queues[0].put(_DONE)
+
+    async def consume():
+        while True:
+            item = await queues[-1].get()
+            if item is _DONE:
+                return
+            sink(item)
+
+    await asyncio.gather(
+        produce(),
+        *(_run_stage(stage, queues[i], queues[i + 1]) for i, stage in enumerate(stages)),
+        consume()
+    )
+    return stages
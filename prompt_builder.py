@@ -0,0 +1,101 @@
+import math
+import threading
+from lexical_index import tokenize
+
+# Rough characters per token for English clinical text; used for budgeting, not billing
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def format_option(option):
+    metadata = option["metadata"]
+    code = metadata["code"]
+    display = metadata.get('display', 'N/A')
+    rank = metadata.get('rank', '-1')
+    return f"Code: {code}, Display: {display}, Rank: {rank}."
+
+def prune_candidates(options, max_k=30, min_k=5, distance_margin=None):
+    """Drop candidates the ranker is unlikely to pick.
+
+    Options are assumed best first. Displays that are identical after tokenizing
+    keep only their best option per system. Past the first min_k, an option is
+    cut once its distance is more than distance_margin worse than the best one,
+    and the list never grows beyond max_k.
+    """
+    kept = []
+    seen = set()
+    best_distance = options[0].get("distance") if options else None
+    for option in options:
+        metadata = option["metadata"]
+        display_key = (metadata.get('system'), " ".join(tokenize(metadata.get('display', ''))))
+        if display_key in seen:
+            continue
+        distance = option.get("distance")
+        if (len(kept) >= min_k and distance_margin is not None and best_distance is not None
+                and distance is not None and distance - best_distance > distance_margin):
+            break
+        seen.add(display_key)
+        kept.append(option)
+        if len(kept) >= max_k:
+            break
+    return kept
+
+def build_ranking_prompt(header, options, instructions, token_budget=None, min_k=5):
+    """Build the agent topic from header and options, keeping it within token_budget.
+
+    The budget covers instructions plus topic. Options are added best first until
+    the next one would exceed it, but at least min_k are always included. Returns
+    (topic, options included).
+    """
+    used = estimate_tokens(instructions) + estimate_tokens(header + "STANDARD CODE OPTIONS:\n")
+    lines = []
+    for option in options:
+        line = format_option(option)
+        cost = estimate_tokens(line + "\n")
+        if token_budget and len(lines) >= min_k and used + cost > token_budget:
+            break
+        lines.append(line)
+        used += cost
+    topic = header + "STANDARD CODE OPTIONS:\n" + "\n".join(lines)
+    return topic, options[:len(lines)]
+
+class TokenStats:
+    """Run totals of ranking prompt size and, when the model reports it, actual token usage.
+
+    The per-request distributions are kept as run_metrics histograms by create_mapping.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.candidates_retrieved = 0
+        self.candidates_sent = 0
+        self.estimated_input_tokens = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.reported_requests = 0
+        self._lock = threading.Lock()
+
+    def record_prompt(self, retrieved, sent, estimated_tokens):
+        with self._lock:
+            self.requests += 1
+            self.candidates_retrieved += retrieved
+            self.candidates_sent += sent
+            self.estimated_input_tokens += estimated_tokens
+
+    def record_usage(self, input_tokens, output_tokens):
+        with self._lock:
+            self.reported_requests += 1
+            self.input_tokens += input_tokens or 0
+            self.output_tokens += output_tokens or 0
+
+    def summary(self):
+        if not self.requests:
+            return "Prompt tokens: no ranking prompts built"
+        text = (f"Prompt tokens: {self.requests} prompts, "
+                f"{self.candidates_sent / self.requests:.1f} of {self.candidates_retrieved / self.requests:.1f} "
+                f"candidates sent on average, ~{self.estimated_input_tokens / self.requests:.0f} estimated input tokens per prompt")
+        if self.reported_requests:
+            text += (f"; model reported {self.input_tokens / self.reported_requests:.0f} input and "
+                     f"{self.output_tokens / self.reported_requests:.0f} output tokens per request")
+        return text
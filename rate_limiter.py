@@ -0,0 +1,94 @@
+import asyncio
+import time
+from contextlib import nullcontext
+
+class AdaptiveRateLimiter:
+    """AIMD concurrency limiter for Bedrock calls.
+
+    Every successful call raises the number of calls allowed in flight by
+    increase / limit (about +increase per full window), and a throttled call
+    multiplies it by decrease_factor. Decreases are spaced by cooldown seconds
+    so a burst of throttles from one window only backs off once. Calls that
+    failed for another reason, or were cancelled, release with failed=True:
+    their slot is freed and the limit stays where it is.
+    """
+
+    def __init__(self, max_limit, initial_limit=None, min_limit=1, increase=1.0,
+                 decrease_factor=0.5, cooldown=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(min(initial_limit or max_limit, max_limit))
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self.failures = 0
+        self._last_decrease = 0.0
+        self._condition = None
+
+    def _get_condition(self):
+        # Created lazily so the limiter can be built outside the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            while self.in_flight >= max(self.min_limit, int(self.limit)):
+                await condition.wait()
+            self.in_flight += 1
+
+    async def release(self, throttled=False, failed=False):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            if failed:
+                self.failures += 1
+            elif throttled:
+                self.throttles += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            else:
+                self.successes += 1
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            condition.notify_all()
+
+    def summary(self):
+        return (f"limit {self.limit:.1f}/{self.max_limit}, {self.in_flight} in flight, "
+                f"{self.successes} ok, {self.throttles} throttled, {self.failures} failed")
+
+async def call_with_backoff(make_call, limiter, max_retries=5, metrics=None, **labels):
+    """Await make_call() under limiter, retrying throttled calls with exponential backoff.
+
+    make_call returns a new awaitable for every attempt. Given metrics (a RunMetrics),
+    limiter waits, retries, throttle waits and final errors are recorded with labels.
+    """
+    for attempt in range(max_retries):
+        with metrics.timer('limiter_wait_seconds', **labels) if metrics else nullcontext():
+            await limiter.acquire()
+        throttled = succeeded = False
+        try:
+            result = await make_call()
+            succeeded = True
+            return result
+        except Exception as e:
+            throttled = "ThrottlingException" in str(e)
+            if not throttled or attempt == max_retries - 1:
+                if metrics:
+                    metrics.increment('call_errors_total', **labels)
+                raise e
+        finally:
+            # Also runs when the caller is cancelled mid-call, so the slot is given back
+            # without counting as a success
+            await limiter.release(throttled=throttled, failed=not (succeeded or throttled))
+        wait_time = (2 ** attempt) + (time.time() % 1)
+        if metrics:
+            metrics.increment('call_retries_total', **labels)
+            metrics.observe('throttle_wait_seconds', wait_time, **labels)
+        print(f"Throttled, waiting {wait_time:.1f}s before retry {attempt + 1} ({limiter.summary()})")
+        await asyncio.sleep(wait_time)
@@ -0,0 +1,101 @@
+import math
+import threading
+from typing import NamedTuple
+import pandas as pd
+
+INPUT_COLUMNS = ['proprietary_code', 'proprietary_display', 'type', 'average', 'categories']
+INPUT_CHUNK_SIZE = 10000
+
+class ProprietaryRow(NamedTuple):
+    """One input row; seq is its position in the input file.
+
+    average keeps the value as given ("12.5", "<5", "N/A"), so prompts show what the
+    source system recorded; it is NaN when missing.
+    """
+    seq: int
+    proprietary_code: str
+    proprietary_display: str
+    type: str
+    average: object
+    categories: object
+
+class CandidateRef(NamedTuple):
+    """A retrieved standard code, resolved to its metadata through CandidateCatalog at output time"""
+    key: str
+    distance: float
+
+def _rows_from_columns(first_seq, codes, displays, types, averages, categories):
+    rows = []
+    for offset, (code, display, row_type, average, category) in enumerate(
+            zip(codes, displays, types, averages, categories)):
+        rows.append(ProprietaryRow(
+            first_seq + offset,
+            str(code) if not pd.isna(code) else 'N/A',
+            str(display) if not pd.isna(display) else '',
+            str(row_type),
+            average if not pd.isna(average) else math.nan,
+            category
+        ))
+    return rows
+
+def rows_from_dataframe(df, first_seq=0):
+    """ProprietaryRow records for a DataFrame with the input columns; missing columns read as empty"""
+    columns = [df[column].tolist() if column in df.columns else [None] * len(df) for column in INPUT_COLUMNS]
+    return _rows_from_columns(first_seq, *columns)
+
+def rows_from_records(records, first_seq=0):
+    """ProprietaryRow records for dicts keyed by the input columns"""
+    columns = [[record.get(column) for record in records] for column in INPUT_COLUMNS]
+    return _rows_from_columns(first_seq, *columns)
+
+def read_row_chunks(path, chunksize=INPUT_CHUNK_SIZE):
+    """Yield lists of ProprietaryRow from a CSV or Parquet file, chunksize rows at a time.
+
+    Codes, displays and averages are read as text, so a value reads the same
+    whichever chunk it lands in, and an average that is not a number ("N/A", "<5")
+    is passed through instead of failing the chunk mid-run. Only empty CSV fields
+    read as missing.
+    """
+    seq = 0
+    if path.lower().endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet input requires pyarrow (pip install pyarrow)")
+        batches = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize))
+    else:
+        batches = pd.read_csv(path, chunksize=chunksize,
+                              dtype={'proprietary_code': str, 'proprietary_display': str, 'type': str,
+                                     'average': str, 'categories': str},
+                              keep_default_na=False, na_values={column: [''] for column in INPUT_COLUMNS})
+    for chunk in batches:
+        rows = rows_from_dataframe(chunk, seq)
+        seq += len(rows)
+        yield rows
+
+class CandidateCatalog:
+    """Metadata for every standard code retrieved so far, keyed by vector key.
+
+    Candidates travel through the pipeline as CandidateRef, and each code's
+    metadata is stored once here. Memory is therefore bounded by the size of
+    the standard catalog, not by the number of input rows.
+    """
+
+    def __init__(self):
+        self._metadata = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._metadata)
+
+    def compact(self, options):
+        """Store the metadata of query results and return them as CandidateRef"""
+        refs = []
+        with self._lock:
+            for option in options:
+                self._metadata.setdefault(option['key'], option['metadata'])
+                refs.append(CandidateRef(option['key'], option.get('distance')))
+        return refs
+
+    def metadata(self, key):
+        return self._metadata.get(key, {})
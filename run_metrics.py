@@ -0,0 +1,171 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds; wide enough for cache hits and for throttled agent calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds for per-request token counts and for candidate counts per ranking prompt
+TOKEN_BUCKETS = (250, 500, 750, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 12000, 16000)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 10, 15, 20, 25, 30, 40, 50)
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus layout"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate by linear interpolation inside the bucket holding the q-th observation"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class RunMetrics:
+    """Counters, gauges and timing histograms for one mapping run.
+
+    Every metric is a name plus optional labels. report() returns a JSON-ready
+    dict and to_prometheus() the node_exporter textfile format.
+    """
+
+    def __init__(self, prefix='ehr_mapper'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, buckets=DEFAULT_BUCKETS, **labels):
+        """Add a value to a histogram; buckets only apply when the histogram is first created"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed_async(self, name, handler, **labels):
+        """Wrap a coroutine function so every call is observed under name"""
+        async def timed(*args, **kwargs):
+            with self.timer(name, **labels):
+                return await handler(*args, **kwargs)
+        return timed
+
+    def counter(self, name, **labels):
+        return self.counters.get(self._key(name, labels), 0)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get(self._key(name, labels)) or Histogram()
+
+    def report(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'elapsed_seconds': time.time() - self.started,
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                'histograms': [{
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'p50': histogram.quantile(0.5),
+                    'p95': histogram.quantile(0.95),
+                    'buckets': [[bound if bound != float('inf') else '+Inf', count]
+                                for bound, count in histogram.cumulative()]
+                } for (name, labels), histogram in sorted(self.histograms.items())]
+            }
+
+    def _series(self, name, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return f"{self.prefix}_{name}"
+        rendered = ",".join(f'{key}="{value}"' for key, value in pairs)
+        return f"{self.prefix}_{name}{{{rendered}}}"
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(metrics.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+                        typed.add(name)
+                    lines.append(f"{self._series(name, labels)} {value}")
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                    typed.add(name)
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{self._series(name + '_bucket', labels, [('le', le)])} {count}")
+                lines.append(f"{self._series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{self._series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the report as Prometheus text for *.prom paths, JSON otherwise.
+
+        The file is replaced atomically so a textfile collector never reads a partial report.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.report(), f, indent=2)
+        os.replace(temp_path, path)
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""Map a large input in shards, on local processes or on several machines.
+
+Rows are partitioned by a hash of proprietary_code into N shards. A work
+directory holds the plan, one lease file per running shard, one journal per
+shard and worker, and a done file per finished shard, so any machine that
+mounts the directory can run workers against it:
+
+    python shard_runner.py plan INPUT --shards 16 --work-dir shards
+    python shard_runner.py work --work-dir shards        (on each node, as often as wanted)
+    python shard_runner.py status --work-dir shards
+    python shard_runner.py merge --work-dir shards --fhir concept_map.json
+
+or all of it on this machine with local worker processes:
+
+    python shard_runner.py run INPUT --shards 16 --processes 4 --fhir concept_map.json
+
+A worker renews its lease while it maps a shard. A lease that is not renewed
+within SHARD_LEASE_SECONDS (or whose process died on this host) is taken over
+by the next worker, which skips the rows already journaled for that shard.
+Shards that fail are retried up to SHARD_MAX_ATTEMPTS times.
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from mapping_journal import MappingJournal, compact_journals
+from row_records import read_row_chunks
+
+# Seconds a lease stays valid without renewal; workers renew every quarter of it
+SHARD_LEASE_SECONDS = float(os.environ.get('SHARD_LEASE_SECONDS', '120'))
+SHARD_MAX_ATTEMPTS = int(os.environ.get('SHARD_MAX_ATTEMPTS', '3'))
+STATUS_INTERVAL = float(os.environ.get('SHARD_STATUS_SECONDS', '10'))
+PLAN_FILE = 'plan.json'
+
+def shard_of(prop_code, shards):
+    """Stable shard number for a code, the same in every process and on every machine"""
+    digest = hashlib.sha1(str(prop_code).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+def shard_rows(input_path, shard, shards, chunksize):
+    """Row chunks of the input restricted to one shard; rows keep their position in the whole input"""
+    for rows in read_row_chunks(input_path, chunksize):
+        yield [row for row in rows if shard_of(row.proprietary_code, shards) == shard]
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _age(path):
+    try:
+        return time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return float('inf')
+
+def _write_json(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+class ShardQueue:
+    """Work queue kept as files in a directory shared by every worker"""
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.plan = _read_json(os.path.join(work_dir, PLAN_FILE))
+        if self.plan is None:
+            raise FileNotFoundError(f"No shard plan in {work_dir}; create one with 'shard_runner.py plan'")
+
+    @classmethod
+    def create(cls, work_dir, input_path, shards):
+        """Write the plan, or reuse an existing plan for the same input and shard count"""
+        plan = {'input': os.path.abspath(input_path), 'shards': shards}
+        existing = _read_json(os.path.join(work_dir, PLAN_FILE))
+        if existing is not None and {key: existing.get(key) for key in plan} != plan:
+            raise ValueError(f"{work_dir} already holds a plan for {existing['input']} in {existing['shards']} shards")
+        if existing is None:
+            for name in ('shards', 'leases', 'logs'):
+                os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+            _write_json(os.path.join(work_dir, PLAN_FILE), {**plan, 'created': time.time()})
+        return cls(work_dir)
+
+    @property
+    def shards(self):
+        return self.plan['shards']
+
+    def path(self, shard, suffix, folder='shards'):
+        return os.path.join(self.work_dir, folder, f"shard-{shard:04d}.{suffix}")
+
+    def journal_paths(self, shard):
+        return sorted(glob.glob(self.path(shard, '*.journal.jsonl')))
+
+    def done(self, shard):
+        return _read_json(self.path(shard, 'done.json'))
+
+    def failures(self, shard):
+        return _read_json(self.path(shard, 'failed.json')) or {'attempts': 0, 'errors': []}
+
+    def lease(self, shard):
+        return _read_json(self.path(shard, 'lease', 'leases'))
+
+    def _lease_stale(self, lease):
+        if lease is None:
+            return True
+        if lease['expires'] < time.time():
+            return True
+        return lease['host'] == socket.gethostname() and not _pid_alive(lease['pid'])
+
+    def _lease_record(self, worker_id, mapped=0):
+        return {'worker': worker_id, 'host': socket.gethostname(), 'pid': os.getpid(),
+                'expires': time.time() + SHARD_LEASE_SECONDS, 'mapped': mapped}
+
+    def _acquire(self, shard, worker_id):
+        lease_path = self.path(shard, 'lease', 'leases')
+        for _ in range(2):
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                lease = self.lease(shard)
+                if lease is None and _age(lease_path) < 10:
+                    # Just created and not yet written by the worker that holds it
+                    return False
+                if not self._lease_stale(lease):
+                    return False
+                # Renaming is atomic, so only one worker takes over a stale lease
+                stale_path = f"{lease_path}.stale.{worker_id}"
+                try:
+                    os.rename(lease_path, stale_path)
+                except FileNotFoundError:
+                    continue
+                if _read_json(stale_path) != lease:
+                    # Another worker replaced the lease after we read it; give it back
+                    os.rename(stale_path, lease_path)
+                    return False
+                os.remove(stale_path)
+                if lease is not None:
+                    self.mark_failed(shard, lease['worker'], 'lease expired')
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._lease_record(worker_id), f)
+            return True
+        return False
+
+    def claim(self, worker_id):
+        """Lease the first shard that is not done, running or out of attempts; None when there is none"""
+        for shard in range(self.shards):
+            if self.done(shard) is not None or self.failures(shard)['attempts'] >= SHARD_MAX_ATTEMPTS:
+                continue
+            if self._acquire(shard, worker_id):
+                # The shard may have finished between the check and the lease
+                if self.done(shard) is not None:
+                    self.release(shard, worker_id)
+                    continue
+                return shard
+        return None
+
+    def renew(self, shard, worker_id, mapped):
+        """Extend our lease; False when another worker has taken the shard over"""
+        lease = self.lease(shard)
+        if lease is None or lease['worker'] != worker_id:
+            return False
+        _write_json(self.path(shard, 'lease', 'leases'), self._lease_record(worker_id, mapped))
+        return True
+
+    def release(self, shard, worker_id):
+        lease = self.lease(shard)
+        if lease is not None and lease['worker'] == worker_id:
+            try:
+                os.remove(self.path(shard, 'lease', 'leases'))
+            except FileNotFoundError:
+                pass
+
+    def mark_done(self, shard, info):
+        _write_json(self.path(shard, 'done.json'), info)
+
+    def mark_failed(self, shard, worker_id, error):
+        failures = self.failures(shard)
+        failures['attempts'] += 1
+        failures['errors'].append({'worker': worker_id, 'error': error, 'time': time.time()})
+        _write_json(self.path(shard, 'failed.json'), failures)
+
+    def status(self):
+        """One dict per shard with its state: done, running, failed (out of attempts) or pending"""
+        shards = []
+        for shard in range(self.shards):
+            done = self.done(shard)
+            lease = self.lease(shard)
+            failures = self.failures(shard)
+            if done is not None:
+                state = {'state': 'done', 'mapped': done['mapped'], 'worker': done['worker']}
+            elif lease is not None and not self._lease_stale(lease):
+                state = {'state': 'running', 'mapped': lease['mapped'], 'worker': lease['worker']}
+            elif failures['attempts'] >= SHARD_MAX_ATTEMPTS:
+                state = {'state': 'failed', 'mapped': 0, 'worker': None}
+            else:
+                state = {'state': 'pending', 'mapped': 0, 'worker': None}
+            shards.append({'shard': shard, 'attempts': failures['attempts'], **state})
+        return shards
+
+class LeaseKeeper(threading.Thread):
+    """Renews a shard lease in the background until stopped or taken over"""
+
+    def __init__(self, queue, shard, worker_id, progress):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.shard = shard
+        self.worker_id = worker_id
+        self.progress = progress
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(SHARD_LEASE_SECONDS / 4):
+            if not self.queue.renew(self.shard, self.worker_id, self.progress['mapped']):
+                self.lost = True
+                print(f"Lost the lease on shard {self.shard}; another worker took it over")
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+async def map_shard(queue, shard, worker_id, input_path, limiter):
+    """Map one leased shard into this worker's journal for it; returns the done info, or None if the lease was lost"""
+    import create_mapping
+    existing = queue.journal_paths(shard)
+    skip_seqs = set()
+    for path in existing:
+        skip_seqs |= MappingJournal(path).completed_seqs()
+    journal = MappingJournal(queue.path(shard, f"{worker_id}.journal.jsonl"))
+    journal.start(input_path, resume=journal.path in existing)
+    progress = {'mapped': len(skip_seqs)}
+
+    def on_mapping(seq, mapping_row):
+        journal.append(seq, mapping_row)
+        progress['mapped'] += 1
+
+    keeper = LeaseKeeper(queue, shard, worker_id, progress)
+    keeper.start()
+    start = time.time()
+    try:
+        rows = shard_rows(input_path, shard, queue.shards, create_mapping.INPUT_CHUNK_SIZE)
+        stats = await create_mapping.map_rows(rows, on_mapping, skip_seqs, limiter)
+    finally:
+        keeper.stop()
+        journal.close()
+    if keeper.lost:
+        return None
+    if stats['failed']:
+        # The shard is retried like any other failure, skipping the rows journaled so far
+        raise RuntimeError(f"{stats['failed']} rows failed to map")
+    mapped = compact_journals(queue.journal_paths(shard), queue.path(shard, 'csv'))
+    return {'worker': worker_id, 'mapped': mapped, 'seconds': time.time() - start, 'finished': time.time()}
+
+async def work(queue, worker_id, input_path):
+    """Claim and map shards until none are left; returns the numbers of shards this worker finished and failed"""
+    import create_mapping
+    limiter = create_mapping.AdaptiveRateLimiter(
+        create_mapping.MAPPING_CONCURRENCY, create_mapping.MAPPING_INITIAL_CONCURRENCY
+    )
+    finished = failed = 0
+    while True:
+        shard = queue.claim(worker_id)
+        if shard is None:
+            return finished, failed
+        print(f"Worker {worker_id} mapping shard {shard} of {queue.shards}")
+        try:
+            info = await map_shard(queue, shard, worker_id, input_path, limiter)
+            if info is not None:
+                queue.mark_done(shard, info)
+                finished += 1
+                print(f"Shard {shard} done: {info['mapped']} mappings in {info['seconds']:.1f}s")
+        except Exception as e:
+            print(f"Shard {shard} failed: {e}")
+            queue.mark_failed(shard, worker_id, str(e))
+            failed += 1
+        finally:
+            queue.release(shard, worker_id)
+
+def print_status(queue):
+    shards = queue.status()
+    counts = {}
+    for shard in shards:
+        counts[shard['state']] = counts.get(shard['state'], 0) + 1
+    mapped = sum(shard['mapped'] for shard in shards)
+    print(f"{queue.shards} shards: " + ", ".join(f"{count} {state}" for state, count in sorted(counts.items()))
+          + f"; {mapped} rows mapped")
+    for shard in shards:
+        if shard['state'] in ('running', 'failed') or shard['attempts']:
+            print(f"  shard {shard['shard']}: {shard['state']}, {shard['mapped']} mapped, "
+                  f"{shard['attempts']} failed attempts" + (f", worker {shard['worker']}" if shard['worker'] else ""))
+    return shards
+
+def merge(queue, output_path, fhir_path=None, partial=False):
+    """Combine every shard's journals into one mapping CSV in input order, and optionally a FHIR ConceptMap"""
+    unfinished = [shard['shard'] for shard in queue.status() if shard['state'] != 'done']
+    if unfinished and not partial:
+        raise RuntimeError(f"{len(unfinished)} shards are not done ({', '.join(map(str, unfinished[:10]))}); "
+                           "run more workers or merge with --partial")
+    paths = [path for shard in range(queue.shards) for path in queue.journal_paths(shard)]
+    count = compact_journals(paths, output_path)
+    print(f"Merged {count} mappings from {queue.shards} shards into '{output_path}'")
+    if fhir_path:
+        from csv_to_fhir import write_fhir_conceptmap
+        write_fhir_conceptmap(output_path, fhir_path)
+        print(f"Wrote FHIR ConceptMap to '{fhir_path}'")
+    return count
+
+def run_local(queue, processes):
+    """Run worker processes on this machine until every shard is done or out of attempts"""
+    while True:
+        claimable = [shard for shard in queue.status() if shard['state'] == 'pending']
+        if not claimable:
+            return
+        workers = []
+        for i in range(min(processes, len(claimable))):
+            log = open(os.path.join(queue.work_dir, 'logs', f"worker-{i}.log"), 'a')
+            workers.append((subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'work', '--work-dir', queue.work_dir],
+                stdout=log, stderr=subprocess.STDOUT
+            ), log))
+        print(f"Started {len(workers)} worker processes; logs in {os.path.join(queue.work_dir, 'logs')}")
+        while any(process.poll() is None for process, _ in workers):
+            time.sleep(STATUS_INTERVAL)
+            print_status(queue)
+        for process, log in workers:
+            log.close()
+            if process.returncode:
+                print(f"Worker process {process.pid} exited with code {process.returncode}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded create_mapping runner")
+    commands = parser.add_subparsers(dest='command', required=True)
+    plan_parser = commands.add_parser('plan', help="create the work directory for an input file")
+    run_parser = commands.add_parser('run', help="plan, map with local worker processes and merge")
+    for sub in (plan_parser, run_parser):
+        sub.add_argument('input')
+        sub.add_argument('--shards', type=int, default=8)
+    run_parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    work_parser = commands.add_parser('work', help="claim and map shards until none are left")
+    work_parser.add_argument('--worker-id', default=None)
+    work_parser.add_argument('--input', default=None, help="input path on this machine, if it differs from the plan")
+    commands.add_parser('status', help="show per-shard progress")
+    merge_parser = commands.add_parser('merge', help="write the merged mapping CSV")
+    merge_parser.add_argument('--partial', action='store_true', help="merge even if some shards are not done")
+    for sub in (run_parser, merge_parser):
+        sub.add_argument('--output', default='ehr_code_mappings.csv')
+        sub.add_argument('--fhir', default=None, help="also write a FHIR ConceptMap to this path")
+    for sub in (plan_parser, run_parser, work_parser, commands.choices['status'], merge_parser):
+        sub.add_argument('--work-dir', default='mapping_shards')
+    args = parser.parse_args()
+
+    if args.command in ('plan', 'run'):
+        queue = ShardQueue.create(args.work_dir, args.input, args.shards)
+        print(f"Planned {args.shards} shards of {queue.plan['input']} in {args.work_dir}")
+        if args.command == 'run':
+            run_local(queue, args.processes)
+            if any(shard['state'] != 'done' for shard in print_status(queue)):
+                print("Error: some shards are not done; see the worker logs, then run again to retry them")
+                sys.exit(1)
+            merge(queue, args.output, args.fhir)
+    elif args.command == 'work':
+        queue = ShardQueue(args.work_dir)
+        worker_id = args.worker_id or default_worker_id()
+        finished, failed = asyncio.run(work(queue, worker_id, args.input or queue.plan['input']))
+        print(f"Worker {worker_id} finished {finished} shards" + (f"; {failed} shard attempts failed" if failed else ""))
+        if failed:
+            sys.exit(1)
+    elif args.command == 'status':
+        print_status(ShardQueue(args.work_dir))
+    elif args.command == 'merge':
+        queue = ShardQueue(args.work_dir)
+        try:
+            merge(queue, args.output, args.fhir, args.partial)
+        except RuntimeError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
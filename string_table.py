@@ -0,0 +1,92 @@
+import json
+import os
+import numpy as np
+
+TABLE_FILE = 'table.json'
+
+class StringColumn:
+    """Read-only sequence of strings stored as one UTF-8 blob plus int64 end offsets.
+
+    Both arrays can be memory-mapped, so processes reading the same column
+    share its pages instead of each holding a list of Python strings.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [str(value).encode('utf-8') for value in strings]
+        offsets = np.cumsum([len(value) for value in encoded], dtype=np.int64)
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        offsets = np.load(f"{path}.offsets.npy", mmap_mode='r' if mmap else None)
+        if offsets.size and offsets[-1] > 0:
+            data = np.memmap(f"{path}.bin", dtype=np.uint8, mode='r') if mmap else np.fromfile(f"{path}.bin", dtype=np.uint8)
+        else:
+            data = np.zeros(0, dtype=np.uint8)
+        return cls(data, offsets)
+
+    def save(self, path):
+        np.asarray(self.data, dtype=np.uint8).tofile(f"{path}.bin")
+        np.save(f"{path}.offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.offsets)
+        start = int(self.offsets[i - 1]) if i else 0
+        return bytes(self.data[start:int(self.offsets[i])]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self[i]
+
+class ColumnarMetadata:
+    """Per-vector metadata dicts stored column by column; indexing returns a fresh dict.
+
+    Missing values are stored and read back as empty strings.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_dicts(cls, metadata):
+        names = list(dict.fromkeys(name for meta in metadata for name in meta))
+        return cls({name: StringColumn.from_strings(meta.get(name, '') for meta in metadata) for name in names})
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, i):
+        return {name: column[i] for name, column in self.columns.items()}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def save_table(table_dir, keys, metadata, **extra):
+    """Write keys and metadata as string columns, plus a table.json listing them and any extra fields"""
+    os.makedirs(table_dir, exist_ok=True)
+    columnar = metadata if isinstance(metadata, ColumnarMetadata) else ColumnarMetadata.from_dicts(metadata)
+    key_column = keys if isinstance(keys, StringColumn) else StringColumn.from_strings(keys)
+    key_column.save(os.path.join(table_dir, 'column_key'))
+    for i, (name, column) in enumerate(columnar.columns.items()):
+        column.save(os.path.join(table_dir, f'column_{i}'))
+    with open(os.path.join(table_dir, TABLE_FILE), 'w') as f:
+        json.dump({'count': len(key_column), 'columns': list(columnar.columns), **extra}, f)
+
+def load_table(table_dir, mmap=True):
+    """Return (keys, metadata, table) as saved by save_table"""
+    with open(os.path.join(table_dir, TABLE_FILE)) as f:
+        table = json.load(f)
+    keys = StringColumn.load(os.path.join(table_dir, 'column_key'), mmap)
+    columns = {name: StringColumn.load(os.path.join(table_dir, f'column_{i}'), mmap)
+               for i, name in enumerate(table['columns'])}
+    return keys, ColumnarMetadata(columns), table
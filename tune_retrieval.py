@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Measure how topK, embedding dimensions and the re-enhancement threshold trade recall for cost.
+
+Given a gold mapping (prop_code -> accepted standard code, e.g. the
+validated_mappings.csv exported by validate_mappings.html), the proprietary
+input it came from and the standard catalog, this embeds the catalog into an
+in-memory local index for every dimension and replays vector retrieval the
+way create_mapping.py does it:
+
+    python tune_retrieval.py --gold validated_mappings.csv --input proprietary.csv \\
+        --catalog standard_codes.csv --top-k 10,20,30,50 --dimensions 256,512,1024 \\
+        --thresholds 0.55,0.65,0.75
+
+For every (dimensions, threshold, topK) it reports recall@k over the retrieved
+candidates, recall over the candidates that survive pruning into the ranking
+prompt, the re-enhancement rate, Titan and Claude calls per row, estimated
+prompt tokens, query latency and index memory. Lexical shortcuts are not
+applied, so every gold row goes through vector retrieval. Titan embeddings go
+through the embedding cache (one per dimension count); with
+EMBEDDING_PROVIDER=local a local embedder is fitted on the catalog for every
+dimension count instead. Each query text is expanded or re-enhanced at most
+once across the whole sweep.
+"""
+import argparse
+import asyncio
+import time
+import numpy as np
+import pandas as pd
+import create_mapping
+import generate_embeddings
+from embedding_cache import open_embedder_cache
+from embedding_providers import BedrockEmbedder, TfidfSvdEmbedder
+from local_index import LocalVectorIndex
+from prompt_builder import build_ranking_prompt, estimate_tokens, prune_candidates
+from rate_limiter import AdaptiveRateLimiter
+from row_records import read_row_chunks
+
+# Columns of the gold file holding the accepted standard code, in order of preference
+GOLD_CODE_COLUMNS = ['validated_code', 'standard_code', 'code']
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+def load_gold(path):
+    """prop_code -> set of accepted standard codes; a code may have several gold rows"""
+    df = pd.read_csv(path, dtype=str)
+    code_column = next((column for column in GOLD_CODE_COLUMNS if column in df.columns), None)
+    if 'prop_code' not in df.columns or code_column is None:
+        raise ValueError(f"{path} needs a prop_code column and one of {', '.join(GOLD_CODE_COLUMNS)}")
+    gold = {}
+    for prop_code, code in zip(df['prop_code'], df[code_column]):
+        if pd.isna(prop_code) or pd.isna(code) or code.strip() in ('', 'N/A'):
+            continue
+        gold.setdefault(prop_code.strip(), set()).add(code.strip())
+    return gold
+
+def load_gold_rows(input_path, gold):
+    """Input rows that have a gold mapping, in input order"""
+    rows = []
+    for chunk in read_row_chunks(input_path):
+        rows.extend(row for row in chunk if row.proprietary_code in gold)
+    return rows
+
+def make_embedder(dimensions, catalog_df):
+    if create_mapping.EMBEDDING_PROVIDER == 'local':
+        return TfidfSvdEmbedder.fit(catalog_df['STANDARD_DISPLAY'].astype(str).tolist(), dimensions)
+    return BedrockEmbedder(create_mapping.get_bedrock(), create_mapping.EMBEDDING_MODEL_ID, dimensions)
+
+async def embed_texts(texts, embedder, embedding_cache):
+    if embedder.batch_native:
+        return await asyncio.to_thread(embedder.embed, texts)
+    limiter = AdaptiveRateLimiter(generate_embeddings.EMBED_CONCURRENCY, generate_embeddings.EMBED_INITIAL_CONCURRENCY)
+    return await asyncio.gather(*(
+        generate_embeddings.embed_with_backoff(text, embedder.embed_one, limiter, embedding_cache) for text in texts
+    ))
+
+async def build_index(catalog_df, embedder, embedding_cache):
+    index = LocalVectorIndex.empty()
+    
+    def upload_batch(vectors_batch):
+        index.put_vectors(vectors=vectors_batch)
+        return len(vectors_batch)
+    
+    await generate_embeddings.ingest_batches(catalog_df, embedder, upload_batch, embedding_cache)
+    index._apply_pending()
+    return index
+
+def best_distance(options):
+    return options[0]['distance'] if options else None
+
+def gold_found(options, codes):
+    return any(option['metadata'].get('code') in codes for option in options)
+
+def prompt_options(row, options, top_k):
+    """Candidates the ranking prompt would include with PROMPT_MAX_CANDIDATES set to top_k, and its tokens"""
+    options = prune_candidates(
+        options[:top_k],
+        max_k=top_k,
+        min_k=create_mapping.PROMPT_MIN_CANDIDATES,
+        distance_margin=create_mapping.PROMPT_DISTANCE_MARGIN
+    )
+    topic, options = build_ranking_prompt(
+        create_mapping.ranking_header(row.proprietary_display, row), options,
+        create_mapping.AGENT_INSTRUCTIONS, create_mapping.PROMPT_TOKEN_BUDGET, create_mapping.PROMPT_MIN_CANDIDATES
+    )
+    return options, estimate_tokens(create_mapping.AGENT_INSTRUCTIONS) + estimate_tokens(topic)
+
+def timed_queries(index, matrix, top_k):
+    start = time.perf_counter()
+    results = index.query_batch(matrix, top_k)
+    return results, 1000 * (time.perf_counter() - start) / max(len(matrix), 1)
+
+async def claude_texts(make_text, items):
+    """make_text(item, limiter) for every item, under one AIMD limiter as create_mapping runs Claude calls"""
+    limiter = AdaptiveRateLimiter(create_mapping.MAPPING_CONCURRENCY, create_mapping.MAPPING_INITIAL_CONCURRENCY)
+    return await asyncio.gather(*(make_text(item, limiter) for item in items))
+
+class RetrievalSweep:
+    """Runs the sweep, expanding and re-enhancing each row's text at most once"""
+    
+    def __init__(self, rows, gold, catalog_df, top_ks, thresholds):
+        self.rows = rows
+        self.gold = gold
+        self.catalog_df = catalog_df
+        self.top_ks = sorted(top_ks)
+        self.thresholds = sorted(thresholds)
+        self.query_texts = asyncio.run(claude_texts(
+            lambda row, limiter: create_mapping.get_query_text(row.proprietary_display, row, limiter), rows
+        ))
+        self.expanded = sum(
+            create_mapping.needs_acronym_expansion(create_mapping.clean_display(row.proprietary_display)) for row in rows
+        )
+        # row position -> re-enhanced text, filled in for rows over the lowest threshold at any dimension
+        self.re_enhanced = {}
+    
+    def re_enhance(self, positions):
+        missing = [i for i in positions if i not in self.re_enhanced]
+        texts = asyncio.run(claude_texts(
+            lambda i, limiter: create_mapping.rephrase_display(self.query_texts[i], self.rows[i], limiter), missing
+        ))
+        self.re_enhanced.update(zip(missing, texts))
+    
+    def run_dimensions(self, dimensions):
+        """Result rows for every (threshold, topK) at one dimension count"""
+        print(f"\n{dimensions} dimensions: embedding {len(self.catalog_df)} standard codes")
+        embedder = make_embedder(dimensions, self.catalog_df)
+        embedding_cache = open_embedder_cache(embedder)
+        index = asyncio.run(build_index(self.catalog_df, embedder, embedding_cache))
+        index_mb = index.vectors.nbytes / 2**20
+        
+        vectors = asyncio.run(embed_texts(self.query_texts, embedder, embedding_cache))
+        matrix = np.asarray(vectors, dtype=np.float32)
+        latency = {}
+        for top_k in self.top_ks:
+            first, latency[top_k] = timed_queries(index, matrix, top_k)
+        
+        # Rows over the lowest threshold are re-enhanced once; higher thresholds flag a subset of them
+        flagged = [i for i, options in enumerate(first) if options and best_distance(options) > self.thresholds[0]]
+        self.re_enhance(flagged)
+        second = {}
+        if flagged:
+            second_vectors = asyncio.run(embed_texts([self.re_enhanced[i] for i in flagged], embedder, embedding_cache))
+            second = dict(zip(flagged, index.query_batch(np.asarray(second_vectors, dtype=np.float32), self.top_ks[-1])))
+        if embedding_cache is not None:
+            embedding_cache.close()
+        
+        results = []
+        for threshold in self.thresholds:
+            final = [second[i] if options and best_distance(options) > threshold else options
+                     for i, options in enumerate(first)]
+            re_enhance_rate = sum(
+                1 for options in first if options and best_distance(options) > threshold
+            ) / len(self.rows)
+            for top_k in self.top_ks:
+                recall = prompt_recall = tokens = candidates = 0
+                for row, options in zip(self.rows, final):
+                    codes = self.gold[row.proprietary_code]
+                    included, prompt_tokens = prompt_options(row, options, top_k)
+                    recall += gold_found(options[:top_k], codes)
+                    prompt_recall += gold_found(included, codes)
+                    tokens += prompt_tokens
+                    candidates += len(included)
+                results.append({
+                    'dimensions': dimensions,
+                    'threshold': threshold,
+                    'top_k': top_k,
+                    'recall_at_k': recall / len(self.rows),
+                    'prompt_recall': prompt_recall / len(self.rows),
+                    're_enhance_rate': re_enhance_rate,
+                    'embedding_calls_per_row': 1 + re_enhance_rate,
+                    'claude_calls_per_row': self.expanded / len(self.rows) + re_enhance_rate + 1,
+                    'prompt_candidates': candidates / len(self.rows),
+                    'prompt_tokens': tokens / len(self.rows),
+                    'query_ms': latency[top_k] * (1 + re_enhance_rate),
+                    'index_mb': index_mb
+                })
+        return results
+
+def cheapest_within(results, tolerance):
+    """The configuration with the fewest prompt tokens whose prompt recall is within tolerance of the best"""
+    best = max(result['prompt_recall'] for result in results)
+    eligible = [result for result in results if result['prompt_recall'] >= best - tolerance]
+    return min(eligible, key=lambda result: (result['prompt_tokens'], result['index_mb'], result['re_enhance_rate']))
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep retrieval settings against a gold mapping")
+    parser.add_argument('--gold', required=True, help="CSV with prop_code and validated_code (or standard_code)")
+    parser.add_argument('--input', required=True, help="proprietary codes CSV or Parquet the gold file was mapped from")
+    parser.add_argument('--catalog', required=True, help="standard codes CSV, as given to generate_embeddings.py")
+    parser.add_argument('--top-k', default='10,20,30,50')
+    parser.add_argument('--dimensions', default='256,512,1024')
+    parser.add_argument('--thresholds', default='0.55,0.6,0.65,0.7,0.75')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help="prompt recall that may be given up when suggesting a cheaper configuration")
+    parser.add_argument('--output', default='retrieval_tuning.csv')
+    args = parser.parse_args()
+    
+    gold = load_gold(args.gold)
+    rows = load_gold_rows(args.input, gold)
+    if not rows:
+        print(f"No rows of {args.input} have a gold mapping in {args.gold}")
+        return
+    catalog_df = pd.read_csv(args.catalog)
+    print(f"{len(rows)} gold rows, {len(catalog_df)} standard codes")
+    
+    sweep = RetrievalSweep(rows, gold, catalog_df, parse_list(args.top_k, int), parse_list(args.thresholds, float))
+    results = []
+    for dimensions in parse_list(args.dimensions, int):
+        results.extend(sweep.run_dimensions(dimensions))
+    
+    df = pd.DataFrame(results)
+    df.to_csv(args.output, index=False)
+    print()
+    print(df.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+    print(f"\nSaved {len(df)} configurations to {args.output}")
+    suggestion = cheapest_within(results, args.tolerance)
+    print(f"Fewest prompt tokens within {args.tolerance:.0%} of the best prompt recall: "
+          f"topK {suggestion['top_k']}, {suggestion['dimensions']} dimensions, threshold {suggestion['threshold']} "
+          f"(prompt recall {suggestion['prompt_recall']:.3f}, {suggestion['prompt_tokens']:.0f} tokens, "
+          f"{suggestion['index_mb']:.1f} MB index)")
+
+if __name__ == "__main__":
+    main()